@@ -0,0 +1,243 @@
+"""Non-interactive bulk prediction over directories, globs and tar archives.
+
+Images are decoded and resized (the same steps as `trial()`) in a process
+pool. Decoded chunks come back through a bounded window of pending tasks and
+are packed into a fixed-size uint8 batch buffer, which is normalized in one
+step (like `test_transforms`) before inference. Every batch is written out
+immediately, so memory use does not grow with the number of input files.
+
+    python batch_predict.py scans/ more/*.png digits.tar.gz -o predictions.csv --top-k 3
+"""
+
+import argparse
+import collections
+import csv
+import glob
+import os
+import sys
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from instrument import NULL_TIMER, Instrumentation, open_sink
+from multilayer_perceptron_cs213 import load_model, mean, std
+from preprocess import DigitNormalizer, decode_digit, prepare_digit, read_digit
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.pgm', '.webp')
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def iter_inputs(inputs):
+    """Yield `(name, source)` pairs, where source is a path or the raw bytes of
+    a tar member. Everything is generated lazily, archives are streamed."""
+    for pattern in inputs:
+        paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        if _is_image(filename):
+                            full = os.path.join(dirpath, filename)
+                            yield full, full
+            elif path.lower().endswith(ARCHIVE_SUFFIXES):
+                with tarfile.open(path, mode='r|*') as archive:
+                    for member in archive:
+                        if member.isfile() and _is_image(member.name):
+                            yield f'{path}:{member.name}', archive.extractfile(member).read()
+            else:
+                yield path, path
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_chunk(chunk):
+    """Runs in a worker: returns names, a `[n, 28, 28]` uint8 array and the
+    `(name, error)` pairs of images that could not be read."""
+    names, images, errors = [], [], []
+    for name, source in chunk:
+        try:
+            image = read_digit(source) if isinstance(source, str) else decode_digit(source)
+            images.append(prepare_digit(image))
+            names.append(name)
+        except Exception as e:
+            errors.append((name, str(e)))
+    images = np.stack(images) if images else np.empty((0, 28, 28), dtype=np.uint8)
+    return names, images, errors
+
+
+def decoded_chunks(inputs, workers, chunk_size, max_pending):
+    """Decode in a process pool, keeping at most `max_pending` chunks in
+    flight and yielding results in input order."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(iter_inputs(inputs), chunk_size):
+            pending.append(pool.submit(decode_chunk, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class CsvWriter:
+
+    def __init__(self, path, k):
+        self.file = sys.stdout if path == '-' else open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        header = ['file', 'prediction']
+        for i in range(1, k + 1):
+            header += [f'top{i}_class', f'top{i}_prob']
+        self.writer.writerow(header)
+
+    def write(self, names, classes, probs):
+        for name, c, p in zip(names, classes, probs):
+            row = [name, int(c[0])]
+            for ci, pi in zip(c, p):
+                row += [int(ci), f'{pi:.6f}']
+            self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, path, k):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit('Parquet output needs pyarrow: pip install pyarrow')
+        self.pa = pa
+        self.k = k
+        fields = [('file', pa.string()), ('prediction', pa.int64())]
+        for i in range(1, k + 1):
+            fields += [(f'top{i}_class', pa.int64()), (f'top{i}_prob', pa.float32())]
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, names, classes, probs):
+        columns = {'file': list(names), 'prediction': classes[:, 0]}
+        for i in range(self.k):
+            columns[f'top{i + 1}_class'] = classes[:, i]
+            columns[f'top{i + 1}_prob'] = probs[:, i]
+        self.writer.write_table(self.pa.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, k):
+    if path.lower().endswith('.parquet'):
+        return ParquetWriter(path, k)
+    return CsvWriter(path, k)
+
+
+def predict(model, inputs, output, batch_size=256, top_k=3, workers=None,
+            chunk_size=64, max_pending=None, instrument=None):
+    """Score every image in `inputs` and write the results to `output`.
+
+    With an `Instrumentation`, time spent waiting for decoded images, packing
+    and normalizing, in the model and writing results is reported.
+
+    Returns `(n_predicted, n_failed)`."""
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2 * workers
+    writer = open_writer(output, top_k)
+    timer = instrument.timer('predict') if instrument is not None else NULL_TIMER
+
+    normalize = DigitNormalizer(mean, std)
+    pixels = np.empty((batch_size, 28, 28), dtype=np.uint8)
+    batch = np.empty((batch_size, 28, 28), dtype=np.float32)
+    batch_names = []
+    n_predicted = 0
+    n_failed = 0
+
+    def flush():
+        nonlocal n_predicted
+        n = len(batch_names)
+        with timer.phase('preprocess'):
+            x = normalize(pixels[:n], out=batch[:n])
+        with timer.phase('forward'), torch.no_grad():
+            y_pred, _ = model(x)
+            probs, classes = F.softmax(y_pred, dim=1).topk(top_k, dim=1)
+        with timer.phase('write'):
+            writer.write(batch_names, classes.numpy(), probs.numpy())
+        n_predicted += n
+        batch_names.clear()
+        timer.step(n)
+
+    try:
+        for names, images, errors in timer.iterate(decoded_chunks(inputs, workers, chunk_size, max_pending)):
+            for name, error in errors:
+                print(f'skipping {name}: {error}', file=sys.stderr)
+            n_failed += len(errors)
+
+            # pack decoded images into the fixed-size buffer
+            offset = 0
+            while offset < len(names):
+                n = min(batch_size - len(batch_names), len(names) - offset)
+                start = len(batch_names)
+                with timer.phase('preprocess'):
+                    pixels[start:start + n] = images[offset:offset + n]
+                batch_names.extend(names[offset:offset + n])
+                offset += n
+                if len(batch_names) == batch_size:
+                    flush()
+        if batch_names:
+            flush()
+        timer.finish()
+    finally:
+        writer.close()
+
+    return n_predicted, n_failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict digits for many images at once.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories, globs or tar archives')
+    parser.add_argument('-o', '--output', default='predictions.csv',
+                        help='.csv or .parquet file to write, - for CSV on stdout')
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None, help='decoding processes')
+    parser.add_argument('--chunk-size', type=int, default=64, help='images per decoding task')
+    parser.add_argument('--metrics', default=None,
+                        help='write phase timings here (.prom for Prometheus text format, else JSON lines)')
+    parser.add_argument('--profile-steps', type=int, default=0,
+                        help='record this many batches with torch.profiler into profiles/')
+    args = parser.parse_args()
+
+    if not 1 <= args.top_k <= 10:
+        parser.error('--top-k must be between 1 and 10')
+
+    instrument = Instrumentation([open_sink(args.metrics)] if args.metrics else [],
+                                 profile_steps=args.profile_steps)
+    with instrument:
+        n_predicted, n_failed = predict(load_model(args.model), args.inputs, args.output,
+                                        args.batch_size, args.top_k, args.workers,
+                                        args.chunk_size, instrument=instrument)
+    print(f'Wrote {n_predicted} predictions to {args.output} ({n_failed} failed)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
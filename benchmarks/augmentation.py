@@ -0,0 +1,64 @@
+"""Compare training-batch throughput of the per-image `train_transforms`
+pipeline against the memory-mapped store + `BatchAugment`.
+
+Run from the repository root:
+
+    python -m benchmarks.augmentation [--images 10000] [--batch-size 64]
+"""
+
+import argparse
+
+import torch
+import torch.utils.data as data
+
+from benchmarks.common import throughput
+from mnist_store import MNISTStore, batch_loader, build_store
+from multilayer_perceptron_cs213 import ROOT, build_augment, build_transforms, mean, std, seed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    build_store(ROOT)
+    subset = MNISTStore(ROOT, train=True).subset(0, args.images)
+
+    # current pipeline: PIL image -> RandomRotation -> RandomCrop -> ToTensor
+    # -> Normalize per sample, then collated by the DataLoader
+    train_transforms, _ = build_transforms()
+    per_image = MNISTStore(ROOT, train=True, transform=train_transforms).subset(0, args.images)
+    per_image_loader = data.DataLoader(per_image, batch_size=args.batch_size,
+                                       shuffle=True, num_workers=args.workers)
+
+    def run_per_image():
+        for x, y in per_image_loader:
+            pass
+
+    # batched pipeline: slices of the store, augmented a batch at a time
+    augment = build_augment()
+    batched_loader = batch_loader(subset, args.batch_size, shuffle=True,
+                                  mean=mean, std=std, num_workers=args.workers)
+
+    def run_batched():
+        for x, y in batched_loader:
+            augment(x)
+
+    torch.manual_seed(seed)
+    results = [
+        ('transforms.Compose (per image)', throughput(run_per_image, args.images, repeat=args.repeat)),
+        ('BatchAugment (per batch)', throughput(run_batched, args.images, repeat=args.repeat)),
+    ]
+
+    print(f'{args.images} images, batch size {args.batch_size}, {args.workers} workers, '
+          f'{torch.get_num_threads()} threads')
+    for name, rate in results:
+        print(f'{name:<32} {rate:>12,.0f} images/sec')
+    print(f'speedup: {results[1][1] / results[0][1]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
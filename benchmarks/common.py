@@ -0,0 +1,45 @@
+"""Small timing helpers shared by the benchmark scripts.
+
+The basic `timings` and `latency` live in the top-level `timing.py`, so
+library code can use them without depending on this package.
+"""
+
+import numpy as np
+
+from timing import timings
+
+PERCENTILES = (50, 90, 99)
+
+
+def summarize(times, scale=1.0):
+    """Mean, min, max and percentiles of `times`, multiplied by `scale`."""
+    times = np.asarray(times) * scale
+    summary = {'mean': float(times.mean()), 'min': float(times.min()), 'max': float(times.max())}
+    for p in PERCENTILES:
+        summary[f'p{p}'] = float(np.percentile(times, p))
+    return summary
+
+
+def throughput(fn, n_items, warmup=1, repeat=3):
+    """Run `fn` `warmup + repeat` times and return the best items/sec.
+
+    `fn` should process `n_items` items per call."""
+    return n_items / min(timings(fn, warmup, repeat))
+
+
+def pin_threads(n):
+    """Use `n` threads for torch (intra- and inter-op) and OpenCV, so results
+    do not depend on how many cores the machine happens to have."""
+    import torch
+
+    torch.set_num_threads(n)
+    try:
+        torch.set_num_interop_threads(n)
+    except RuntimeError:
+        # only possible before any inter-op parallel work has started
+        pass
+    try:
+        import cv2
+        cv2.setNumThreads(n)
+    except ImportError:
+        pass
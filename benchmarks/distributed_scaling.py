@@ -0,0 +1,42 @@
+"""Scaling of `distributed.py` over 1/2/4/8 local processes.
+
+Each process gets `cpu_count // nprocs` threads, so every run uses the same
+cores and the comparison is between threading inside one process and data
+parallelism across processes.
+
+    python -m benchmarks.distributed_scaling [--procs 1 2 4 8] [--epochs 2]
+"""
+
+import argparse
+import os
+import tempfile
+
+import distributed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=64, help='per process')
+    parser.add_argument('--port', type=int, default=29500)
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} CPUs, {args.batch_size} images per process per step')
+    print(f'{"processes":>9} {"images/sec":>12} {"speedup":>8} {"efficiency":>10} {"val acc":>8}')
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, nprocs in enumerate(args.procs):
+            history = distributed.launch(nprocs, args.port + i, epochs=args.epochs,
+                                         batch_size=args.batch_size,
+                                         path=os.path.join(tmp, 'model.pt'), verbose=False)
+            # skip the first epoch (process start-up, first touches of the store)
+            steady = history[1:] or history
+            rate = sum(h['images_per_sec'] for h in steady) / len(steady)
+            baseline = baseline or rate / nprocs
+            print(f'{nprocs:>9} {rate:>12,.0f} {rate / baseline:>7.2f}x '
+                  f'{rate / baseline / nprocs * 100:>9.0f}% {history[-1]["valid_acc"] * 100:>7.2f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Check the exported graphs against eager `MLP.forward` and compare how
+their latency scales with the number of intra-op threads.
+
+    python export.py
+    python -m benchmarks.export [--threads 1 2 4] [--batch-sizes 1 64 1024]
+"""
+
+import argparse
+import os
+
+import torch
+
+from export import check_parity
+from multilayer_perceptron_cs213 import load_model
+from predictor import GraphPredictor
+from timing import latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--torchscript', default='tut1-model.torchscript.pt')
+    parser.add_argument('--onnx', default='tut1-model.onnx')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 1024])
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    for path in (args.torchscript, args.onnx):
+        print(f'{path}: max abs difference from eager {check_parity(model, path):.3g}')
+    print()
+
+    print(f'{"runtime":<12} {"threads":>7} ' + ' '.join(f'{f"batch {b}":>12}' for b in args.batch_sizes))
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        runtimes = [('eager', lambda x: model(torch.from_numpy(x))),
+                    ('torchscript', GraphPredictor.load(args.torchscript, threads)),
+                    ('onnxruntime', GraphPredictor.load(args.onnx, threads))]
+        for name, run in runtimes:
+            timings = []
+            for batch_size in args.batch_sizes:
+                x = torch.randn(batch_size, 28, 28).numpy()
+                with torch.no_grad():
+                    timings.append(latency(lambda: run(x)) * 1000)
+            print(f'{name:<12} {threads:>7} ' + ' '.join(f'{t:>9.3f} ms' for t in timings))
+
+
+if __name__ == '__main__':
+    main()
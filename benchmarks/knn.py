@@ -0,0 +1,78 @@
+"""Query throughput, recall and accuracy of `knn_index.VectorIndex`.
+
+Builds a flat and an IVF index over the training embeddings, queries them
+with the test embeddings and compares the kNN vote with the `output_fc`
+head, overall and on the test images the head is least confident about.
+
+    python -m benchmarks.knn [--model tut1-model.pt] [--nlist 256] [--nprobe 8]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import embeddings
+from knn_index import VectorIndex
+from multilayer_perceptron_cs213 import KNN_CONFIDENCE, load_model
+
+
+def qps(fn, queries, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        fn(queries[i:i + batch_size])
+    return len(queries) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    directory = embeddings.extract(args.model)
+    vectors, labels, split = embeddings.load(directory)
+    train, test = split == 0, split == 1
+    queries = np.asarray(vectors[test][:args.queries], dtype=np.float32)
+    query_labels = labels[test][:args.queries]
+
+    model = load_model(args.model)
+    with torch.no_grad():
+        probs = F.softmax(model.output_fc(torch.from_numpy(queries)), dim=1)
+    head = probs.argmax(1).numpy()
+    unsure = probs.max(1).values.numpy() < KNN_CONFIDENCE
+
+    with tempfile.TemporaryDirectory() as tmp:
+        flat = VectorIndex.build(vectors[train], labels[train], os.path.join(tmp, 'flat'))
+        ivf = VectorIndex.build(vectors[train], labels[train], os.path.join(tmp, 'ivf'), args.nlist)
+
+        _, exact = flat.search(queries, args.k)
+        _, approx = ivf.search(queries, args.k, args.nprobe)
+        recall = np.mean([len(np.intersect1d(flat.ids[e], ivf.ids[a])) / args.k
+                          for e, a in zip(exact, approx)])
+
+        print(f'{int(train.sum())} indexed vectors, {len(queries)} queries, k={args.k}')
+        print(f'{"index":<22} {"1 query/call":>14} {"256 queries/call":>18}')
+        for name, index in (('flat (uint8)', flat), (f'ivf{args.nlist} nprobe={args.nprobe}', ivf)):
+            single = qps(lambda q: index.search(q, args.k, args.nprobe), queries[:500], 1)
+            batched = qps(lambda q: index.search(q, args.k, args.nprobe), queries, 256)
+            print(f'{name:<22} {single:>10,.0f} QPS {batched:>14,.0f} QPS')
+        print(f'IVF recall@{args.k} against flat: {recall * 100:.1f}%')
+
+        vote, _ = flat.knn_predict(queries, args.k)
+        print(f'{"":<22} {"all":>8} {f"confidence < {KNN_CONFIDENCE:g} ({unsure.sum()})":>26}')
+        for name, pred in (('output_fc head', head), (f'{args.k}-NN vote', vote)):
+            correct = pred == query_labels
+            unsure_acc = f'{correct[unsure].mean() * 100:.2f}%' if unsure.any() else '-'
+            print(f'{name:<22} {correct.mean() * 100:>7.2f}% {unsure_acc:>26}')
+
+
+if __name__ == '__main__':
+    main()
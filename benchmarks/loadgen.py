@@ -0,0 +1,91 @@
+"""Load generator for `serve.py`.
+
+Opens `--concurrency` keep-alive connections to a running server and sends
+`--requests` predictions in total, then prints client-side latency
+percentiles and throughput next to the server's own `/stats`.
+
+    python serve.py &
+    python -m benchmarks.loadgen --image test2.png --requests 5000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+async def open_connection(args):
+    if args.unix is not None:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def request(reader, writer, method, path, body=b''):
+    writer.write((f'{method} {path} HTTP/1.1\r\n'
+                  f'Host: localhost\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(args, body, counter, latencies, failures):
+    reader, writer = await open_connection(args)
+    try:
+        while counter[0] < args.requests:
+            counter[0] += 1
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, 'POST', '/predict', body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                failures[0] += 1
+    finally:
+        writer.close()
+
+
+async def run(args):
+    with open(args.image, 'rb') as f:
+        body = f.read()
+
+    counter, failures, latencies = [0], [0], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(args, body, counter, latencies, failures)
+                           for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await open_connection(args)
+    _, server_stats = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+
+    latencies = np.array(latencies) * 1000
+    print(f'{len(latencies)} requests, {args.concurrency} connections, {failures[0]} failed')
+    print(f'throughput: {len(latencies) / elapsed:,.0f} requests/sec')
+    print(f'latency:    p50 {np.percentile(latencies, 50):.2f} ms | '
+          f'p99 {np.percentile(latencies, 99):.2f} ms | max {latencies.max():.2f} ms')
+    print(f'server:     {json.dumps(server_stats)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for serve.py.')
+    parser.add_argument('--image', default='test2.png')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Check `BatchPreprocessor` against `test_transforms` and compare its
+throughput with preprocessing scans one at a time.
+
+The scans are test-set digits inverted to dark-on-light and scaled up to
+`--size` pixels, the kind of image `trial()` is given.
+
+Run from the repository root:
+
+    python -m benchmarks.preprocessing [--images 10000] [--batch-size 256] [--size 112]
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.common import throughput
+from mnist_store import MNISTStore, build_store
+from multilayer_perceptron_cs213 import ROOT, build_transforms, mean, std
+from preprocess import BatchPreprocessor
+
+TOLERANCE = 1e-6
+
+
+def check_parity(digits, batch_size):
+    """28x28 scans must come out exactly as `test_transforms` makes the
+    original digits."""
+    _, test_transforms = build_transforms()
+    preprocess = BatchPreprocessor(mean, std, max_batch=batch_size)
+    worst = 0.0
+    for start in range(0, len(digits), batch_size):
+        chunk = digits[start:start + batch_size]
+        x = preprocess([255 - d for d in chunk])
+        expected = torch.stack([test_transforms(Image.fromarray(d))[0] for d in chunk])
+        worst = max(worst, (x - expected).abs().max().item())
+    if worst > TOLERANCE:
+        raise SystemExit(f'parity check failed: max abs difference {worst:.3g} > {TOLERANCE:g}')
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--size', type=int, default=112, help='side of the synthetic scans')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    build_store(ROOT)
+    test_data = MNISTStore(ROOT, train=False)
+    n = min(args.images, len(test_data))
+    digits = np.asarray(test_data.images[:n])
+
+    worst = check_parity(digits, args.batch_size)
+    print(f'parity with test_transforms on {n} images: max abs difference {worst:.3g}')
+
+    scans = [cv2.resize(255 - d, (args.size, args.size), interpolation=cv2.INTER_LINEAR) for d in digits]
+    batches = [scans[i:i + args.batch_size] for i in range(0, n, args.batch_size)]
+
+    # one image at a time, as trial() did, plus the normalization it was missing
+    def run_per_image():
+        for batch in batches:
+            torch.stack([torch.from_numpy(cv2.bitwise_not(cv2.resize(s, (28, 28), interpolation=cv2.INTER_LINEAR)))
+                         .float().div(255).sub(mean).div(std) for s in batch])
+
+    preprocess = BatchPreprocessor(mean, std, max_batch=args.batch_size)
+    centering = BatchPreprocessor(mean, std, max_batch=args.batch_size, center=True)
+
+    def run_batched():
+        for batch in batches:
+            preprocess(batch)
+
+    def run_centering():
+        for batch in batches:
+            centering(batch)
+
+    results = [
+        ('per image', throughput(run_per_image, n, repeat=args.repeat)),
+        ('BatchPreprocessor', throughput(run_batched, n, repeat=args.repeat)),
+        ('BatchPreprocessor(center=True)', throughput(run_centering, n, repeat=args.repeat)),
+    ]
+
+    print(f'{n} scans of {args.size}x{args.size}, batch size {args.batch_size}')
+    for name, rate in results:
+        print(f'{name:<32} {rate:>12,.0f} images/sec')
+    print(f'speedup: {results[1][1] / results[0][1]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Accuracy and latency of the int8 `QuantizedMLP` against the fp32 `MLP`.
+
+    python quantize.py
+    python -m benchmarks.quantization [--int8 tut1-model-int8.pt]
+"""
+
+import argparse
+
+import torch
+
+import quantize
+from mnist_store import batch_loader
+from multilayer_perceptron_cs213 import load_model, load_splits, mean, std
+from timing import latency
+
+
+def accuracy(model, iterator):
+    correct = 0
+    total = 0
+    with torch.no_grad():
+        for x, y in iterator:
+            y_pred, _ = model(x)
+            correct += (y_pred.argmax(1) == y).sum().item()
+            total += y.shape[0]
+    return correct / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--int8', default='tut1-model-int8.pt')
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    _, _, test_data = load_splits()
+    test_iterator = batch_loader(test_data, 1024, mean=mean, std=std)
+
+    models = [('fp32', load_model(args.model)), ('int8', quantize.load(args.int8))]
+
+    print(f'{torch.get_num_threads()} threads, engine {torch.backends.quantized.engine}')
+    print(f'{"model":<6} {"test acc":>9} {"batch 1":>12} {"batch 256":>12}')
+    accuracies = {}
+    for name, model in models:
+        accuracies[name] = accuracy(model, test_iterator)
+        timings = []
+        for batch_size in (1, 256):
+            x = torch.randn(batch_size, 28, 28)
+            with torch.no_grad():
+                timings.append(latency(lambda: model(x)) * 1000)
+        print(f'{name:<6} {accuracies[name] * 100:>8.2f}% '
+              f'{timings[0]:>9.3f} ms {timings[1]:>9.3f} ms')
+    print(f'accuracy delta (int8 - fp32): {(accuracies["int8"] - accuracies["fp32"]) * 100:+.2f} points')
+
+
+if __name__ == '__main__':
+    main()
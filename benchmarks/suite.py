@@ -0,0 +1,220 @@
+"""Reproducible CPU benchmarks for data loading, the model and `trial()`.
+
+Cases:
+
+- `loading_transforms`: a pass over `--loading-images` training images
+  through the per-image `train_transforms` and a `DataLoader`,
+- `loading_store`: the same images as store slices + `BatchAugment`, which
+  is what `showcase()` trains on,
+- `forward_b1`, `forward_b64`, `forward_b1024`: `MLP.forward` latency,
+- `epoch`: one `train()` epoch as in `showcase()` (batch size 64, Adam),
+- `trial`: one image through the `trial()` path, from reading the PNG and
+  loading the weights to the predicted class.
+
+Every case is warmed up and then timed repeatedly; percentiles are in
+milliseconds. Threads are pinned (`--threads`, 1 by default) and seeds are
+fixed, and everything runs offline against the idx files in `.data/MNIST`.
+Results can be saved as a JSON baseline and later runs compared against it;
+the comparison exits with status 1 if a case's median got more than
+`--tolerance` slower.
+
+    python -m benchmarks.suite --save baseline.json
+    python -m benchmarks.suite --compare baseline.json [--cases forward_b1 trial]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.utils.data as data
+
+from benchmarks.common import pin_threads, summarize, timings
+from mnist_store import MNISTStore, batch_loader
+from multilayer_perceptron_cs213 import (MLP, ROOT, build_augment, build_transforms, load_model, load_splits,
+                                         mean, seed, std, train)
+from preprocess import BatchPreprocessor, read_digit
+
+CASES = ('loading_transforms', 'loading_store', 'forward_b1', 'forward_b64', 'forward_b1024',
+         'epoch', 'trial')
+
+
+def _result(times, items=None):
+    result = summarize(times, scale=1000)
+    result['repeat'] = len(times)
+    if items is not None:
+        result['items'] = items
+        result['items_per_sec'] = items / (result['p50'] / 1000)
+    return result
+
+
+def loading_transforms(args):
+    train_transforms, _ = build_transforms()
+    dataset = MNISTStore(ROOT, train=True, transform=train_transforms).subset(0, args.loading_images)
+    loader = data.DataLoader(dataset, batch_size=64, shuffle=True,
+                             generator=torch.Generator().manual_seed(seed))
+
+    def run():
+        for x, y in loader:
+            pass
+
+    return _result(timings(run, warmup=1, repeat=args.repeat), args.loading_images)
+
+
+def loading_store(args):
+    dataset = MNISTStore(ROOT, train=True).subset(0, args.loading_images)
+    loader = batch_loader(dataset, 64, shuffle=True, mean=mean, std=std, seed=seed)
+    augment = build_augment()
+
+    def run():
+        for x, y in loader:
+            augment(x)
+
+    return _result(timings(run, warmup=1, repeat=args.repeat), args.loading_images)
+
+
+def forward(batch_size):
+    def case(args):
+        model = MLP(28 * 28, 10).eval()
+        x = torch.randn(batch_size, 28, 28, generator=torch.Generator().manual_seed(seed))
+
+        def run():
+            with torch.no_grad():
+                model(x)
+
+        return _result(timings(run, warmup=10, repeat=args.repeat * 100), batch_size)
+    return case
+
+
+def epoch(args):
+    train_data, _, _ = load_splits()
+    if args.epoch_images:
+        train_data = train_data.subset(0, args.epoch_images)
+    iterator = batch_loader(train_data, 64, shuffle=True, mean=mean, std=std, seed=seed)
+    model = MLP(28 * 28, 10)
+    optimizer = optim.Adam(model.parameters())
+    criterion = nn.CrossEntropyLoss()
+    augment = build_augment()
+    device = torch.device('cpu')
+
+    def run():
+        train(model, iterator, optimizer, criterion, device, augment)
+
+    return _result(timings(run, warmup=1, repeat=args.repeat), len(train_data))
+
+
+def trial(args):
+    # a test digit saved as a dark-on-light scan, like the files trial() is given
+    _, _, test_data = load_splits()
+    with tempfile.TemporaryDirectory() as directory:
+        image_path = os.path.join(directory, 'digit.png')
+        scan = cv2.resize(255 - np.asarray(test_data.images[0]), (112, 112))
+        cv2.imwrite(image_path, scan)
+        model_path = os.path.join(directory, 'model.pt')
+        torch.save(MLP(28 * 28, 10).state_dict(), model_path)
+
+        def run():
+            x = BatchPreprocessor(mean, std, max_batch=1)([read_digit(image_path)])
+            model = load_model(model_path)
+            with torch.no_grad():
+                pred, _ = model(x)
+            F.softmax(pred, dim=1).argmax(1).item()
+
+        return _result(timings(run, warmup=10, repeat=args.repeat * 100), 1)
+
+
+RUNNERS = {
+    'loading_transforms': loading_transforms,
+    'loading_store': loading_store,
+    'forward_b1': forward(1),
+    'forward_b64': forward(64),
+    'forward_b1024': forward(1024),
+    'epoch': epoch,
+    'trial': trial,
+}
+
+
+def environment(args):
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'threads': args.threads,
+        'seed': seed,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the median of every case against the baseline; returns the
+    names of cases that are more than `tolerance` slower."""
+    regressions = []
+    print(f'{"case":<20} {"baseline p50":>14} {"p50":>12} {"change":>9}')
+    for name, result in results.items():
+        if name not in baseline['results']:
+            print(f'{name:<20} {"-":>14} {result["p50"]:>9.3f} ms')
+            continue
+        before = baseline['results'][name]['p50']
+        change = result['p50'] / before - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = '  slower'
+        print(f'{name:<20} {before:>11.3f} ms {result["p50"]:>9.3f} ms {change * 100:>+8.1f}%{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed passes for loading and epoch cases; 100x this for latency cases')
+    parser.add_argument('--loading-images', type=int, default=10000)
+    parser.add_argument('--epoch-images', type=int, default=0,
+                        help='train on this many images per epoch (0 for the whole training split)')
+    parser.add_argument('--save', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='compare with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='relative slowdown of the median that counts as a regression')
+    args = parser.parse_args(argv)
+
+    pin_threads(args.threads)
+
+    results = {}
+    for name in args.cases:
+        torch.manual_seed(seed)
+        results[name] = RUNNERS[name](args)
+        r = results[name]
+        rate = f' | {r["items_per_sec"]:,.0f} items/sec' if 'items' in r else ''
+        print(f'{name:<20} p50 {r["p50"]:>9.3f} ms | p90 {r["p90"]:>9.3f} ms | '
+              f'p99 {r["p99"]:>9.3f} ms{rate}', flush=True)
+
+    report = {'environment': environment(args), 'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved results to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != report['environment']:
+            print('note: the baseline was recorded in a different environment', file=sys.stderr)
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
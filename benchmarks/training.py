@@ -0,0 +1,90 @@
+"""Images/sec and time-to-accuracy of `fast_train.fit` against the
+`train()`/`evaluate()` loop used by `showcase()`.
+
+    python -m benchmarks.training [--epochs 10] [--target 0.98] [--batch-size 1024]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import fast_train
+from mnist_store import batch_loader
+from multilayer_perceptron_cs213 import (MLP, build_augment, evaluate, load_splits, mean, seed, seed_everything, std,
+                                         train)
+
+
+def reference(epochs, target):
+    """The showcase() loop: eager fp32, batch size 64, default Adam."""
+    seed_everything()
+    train_data, valid_data, _ = load_splits()
+    train_iterator = batch_loader(train_data, 64, shuffle=True, mean=mean, std=std, seed=seed)
+    valid_iterator = batch_loader(valid_data, 64, mean=mean, std=std)
+
+    device = torch.device('cpu')
+    model = MLP(28 * 28, 10)
+    optimizer = optim.Adam(model.parameters())
+    criterion = nn.CrossEntropyLoss()
+    augment = build_augment()
+
+    history = []
+    elapsed = 0.0
+    for epoch in range(epochs):
+        start_time = time.monotonic()
+        train_iterator.dataset.set_epoch(epoch)
+        train(model, train_iterator, optimizer, criterion, device, augment)
+        train_time = time.monotonic() - start_time
+        _, valid_acc = evaluate(model, valid_iterator, criterion, device)
+        elapsed += time.monotonic() - start_time
+        history.append({'elapsed': elapsed,
+                        'images_per_sec': len(train_data) / train_time,
+                        'valid_acc': valid_acc})
+        if valid_acc >= target:
+            break
+    return history
+
+
+def summarize(name, history, target):
+    # the first epoch includes compilation, so throughput is taken from the rest
+    steady = history[1:] or history
+    images_per_sec = sum(h['images_per_sec'] for h in steady) / len(steady)
+    reached = [h['elapsed'] for h in history if h['valid_acc'] >= target]
+    time_to_target = f'{reached[0]:.1f}s' if reached else 'not reached'
+    print(f'{name:<38} {images_per_sec:>12,.0f} {time_to_target:>14} '
+          f'{history[-1]["valid_acc"] * 100:>9.2f}% ({len(history)} epochs)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--target', type=float, default=0.98)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    runs = [('showcase loop (fp32, eager, bs 64)', lambda path: reference(args.epochs, args.target))]
+    for amp, compile in ((False, False), (True, False), (True, True)):
+        name = (f'fast_train ({"bf16" if amp else "fp32"}, '
+                f'{"compiled" if compile else "eager"}, bs {args.batch_size})')
+        runs.append((name, lambda path, amp=amp, compile=compile: fast_train.fit(
+            args.epochs, args.batch_size, amp=amp, compile=compile, path=path,
+            target_acc=args.target, verbose=False)))
+
+    print(f'{torch.get_num_threads()} threads, target validation accuracy {args.target * 100:.0f}%')
+    print(f'{"run":<38} {"images/sec":>12} {"time to target":>14} {"val acc":>10}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, run in runs:
+            torch.manual_seed(seed)
+            summarize(name, run(os.path.join(tmp, 'model.pt')), args.target)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Resumable training checkpoints.
+
+A checkpoint holds everything needed to continue a run exactly: model and
+optimizer state, the epoch, metric history and the state of every random
+number generator in use. `CheckpointManager` takes a snapshot of that state on
+the training thread and writes it on a background thread, so training is not
+held up by disk I/O. Every file (checkpoints, the manifest and the exported
+best model) is written to a temporary file and atomically renamed into place,
+so a crash mid-write never leaves a corrupt file behind.
+
+The manager keeps the `keep_last` most recent checkpoints and the `keep_best`
+ones with the lowest metric, and deletes the rest. Unless it is asked to
+resume, a new manager starts a new run: the previous run's checkpoints are
+deleted and the best metric starts over.
+"""
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+
+MANIFEST = 'manifest.json'
+
+
+def capture_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(obj):
+    """Copy every tensor in a nested state (to the CPU) so training can keep
+    updating the originals while the copy is being written."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _atomic_write_json(obj, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointManager:
+    """Writes, rotates and finds checkpoints in `directory`.
+
+    If `best_path` is given, the model weights of every checkpoint that
+    improves on the best metric so far are also exported there as a plain
+    `state_dict` (this is how `tut1-model.pt` is produced). Lower metrics are
+    better.
+
+    With `resume=True` the manager picks up the run recorded in the manifest,
+    its checkpoints and its best metric. With `resume=False` it starts a new
+    run and deletes the checkpoints of the previous one.
+    """
+
+    def __init__(self, directory, keep_last=3, keep_best=3, best_path=None, resume=True):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.best_path = best_path
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest = self._read_manifest()
+        if not resume:
+            self._start_run()
+        self._queue = queue.Queue(maxsize=2)
+        self._error = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _read_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(path):
+            return {'run': time.strftime('%Y%m%d-%H%M%S'), 'best': None, 'checkpoints': []}
+        with open(path) as f:
+            manifest = json.load(f)
+        # drop entries whose file is gone (e.g. deleted by hand)
+        manifest['checkpoints'] = [c for c in manifest['checkpoints']
+                                   if os.path.exists(os.path.join(self.directory, c['file']))]
+        if 'best' not in manifest:
+            # manifests written before the best metric was tracked
+            manifest['best'] = min((c['metric'] for c in manifest['checkpoints']), default=None)
+        return manifest
+
+    def _start_run(self):
+        for c in self.manifest['checkpoints']:
+            try:
+                os.remove(os.path.join(self.directory, c['file']))
+            except FileNotFoundError:
+                pass
+        self.manifest = {'run': time.strftime('%Y%m%d-%H%M%S'), 'best': None, 'checkpoints': []}
+        _atomic_write_json(self.manifest, os.path.join(self.directory, MANIFEST))
+
+    def save(self, state, epoch, metric):
+        """Queue `state` to be written as the checkpoint of `epoch`.
+
+        `state` must contain the model weights under 'model'. Returns
+        immediately unless two writes are already pending."""
+        self._raise_pending_error()
+        state = dict(snapshot(state), epoch=epoch, metric=metric)
+        self._queue.put(state)
+
+    def _writer(self):
+        while True:
+            state = self._queue.get()
+            try:
+                if state is None:
+                    return
+                self._write(state)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state):
+        epoch, metric = state['epoch'], state['metric']
+        filename = f'epoch-{epoch:04d}.pt'
+        atomic_save(state, os.path.join(self.directory, filename))
+
+        entries = [c for c in self.manifest['checkpoints'] if c['epoch'] != epoch]
+        entries.append({'file': filename, 'epoch': epoch, 'metric': metric})
+
+        # the best metric of this run, kept even after its checkpoint is rotated out
+        best = self.manifest['best']
+        if best is None or metric < best:
+            self.manifest['best'] = metric
+            if self.best_path is not None:
+                atomic_save(state['model'], self.best_path)
+
+        # rotation: the newest keep_last plus the best keep_best survive
+        by_epoch = sorted(entries, key=lambda c: c['epoch'])[-self.keep_last:] if self.keep_last else []
+        by_metric = sorted(entries, key=lambda c: c['metric'])[:self.keep_best]
+        keep = {c['file'] for c in by_epoch + by_metric}
+
+        self.manifest['checkpoints'] = sorted((c for c in entries if c['file'] in keep),
+                                              key=lambda c: c['epoch'])
+        _atomic_write_json(self.manifest, os.path.join(self.directory, MANIFEST))
+
+        for c in entries:
+            if c['file'] not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, c['file']))
+                except FileNotFoundError:
+                    pass
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise_pending_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def latest(self):
+        """Path of the most recent checkpoint, or None."""
+        self.wait()
+        if not self.manifest['checkpoints']:
+            return None
+        return os.path.join(self.directory, self.manifest['checkpoints'][-1]['file'])
+
+    def best(self):
+        """Paths of the kept checkpoints, best metric first."""
+        self.wait()
+        return [os.path.join(self.directory, c['file'])
+                for c in sorted(self.manifest['checkpoints'], key=lambda c: c['metric'])]
+
+    def load_latest(self, map_location='cpu'):
+        path = self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
@@ -0,0 +1,321 @@
+"""Smaller variants of the trained MLP, and how they trade accuracy for speed.
+
+Three ways of shrinking the model, all fine-tuned against the trained
+`tut1-model.pt` as teacher with knowledge distillation (a mix of the usual
+cross-entropy and the KL divergence to the teacher's softened predictions):
+
+- students: narrower `MLP`s trained from scratch,
+- structured pruning: `input_fc` (784x250, most of the parameters) loses the
+  input pixels and hidden units that contribute least. Their average
+  contribution over the training set is folded into the next bias, so pixels
+  that are nearly always background cost nothing to remove,
+- magnitude pruning: the smallest weights of `input_fc` are zeroed (and kept
+  at zero while fine-tuning), and the layer is stored as a CSR sparse matrix
+  with int16 column indices and run with a sparse matmul.
+
+Every variant is measured for test accuracy, stored parameters and batch-1
+CPU latency, and the Pareto-optimal ones are marked. The fastest variant that
+reaches `--min-accuracy` is saved:
+
+    python compress.py [--students 128x64 64x32] [--sparsity 0.9] [--output tut1-model-compact.pt]
+"""
+
+import argparse
+import copy
+import csv
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+from evaluation import evaluate_split
+from mnist_store import StoreBatches, batch_loader
+from multilayer_perceptron_cs213 import MLP, build_augment, load_model, load_splits, mean, seed, std
+from sweep import parse_hidden
+from timing import latency
+
+TEMPERATURE = 4.0
+ALPHA = 0.9  # weight of the distillation term
+CALIBRATION_IMAGES = 10000
+
+
+class SparseLinear(nn.Module):
+    """`nn.Linear` with a CSR weight matrix."""
+
+    def __init__(self, weight, bias):
+        super().__init__()
+        self.register_buffer('weight', weight.detach().to_sparse_csr())
+        self.bias = nn.Parameter(bias.detach().clone(), requires_grad=False)
+        self.in_features = weight.shape[1]
+        self.out_features = weight.shape[0]
+
+    @classmethod
+    def from_dense(cls, linear):
+        return cls(linear.weight.detach(), linear.bias)
+
+    def forward(self, x):
+        # [out, in] @ [in, batch size], transposed back
+        return torch.sparse.mm(self.weight, x.T).T + self.bias
+
+    def nnz(self):
+        return self.weight.values().numel()
+
+
+class PrunedMLP(nn.Module):
+    """`MLP` that only reads the input pixels in `keep_inputs`, with an
+    `input_fc` that is either dense or a `SparseLinear`."""
+
+    def __init__(self, keep_inputs, input_fc, hidden_fc, output_fc):
+        super().__init__()
+
+        self.register_buffer('keep_inputs', keep_inputs)
+        self.input_fc = input_fc
+        self.hidden_fc = hidden_fc
+        self.output_fc = output_fc
+
+    @classmethod
+    def from_mlp(cls, model):
+        model = copy.deepcopy(model)
+        return cls(torch.arange(model.input_fc.in_features),
+                   model.input_fc, model.hidden_fc, model.output_fc)
+
+    def forward(self, x):
+
+        batch_size = x.shape[0]
+
+        x = x.reshape(batch_size, -1).index_select(1, self.keep_inputs)
+
+        # x = [batch size, kept pixels]
+
+        h_1 = F.relu(self.input_fc(x))
+
+        h_2 = F.relu(self.hidden_fc(h_1))
+
+        y_pred = self.output_fc(h_2)
+
+        return y_pred, h_2
+
+
+def count_parameters(model):
+    """Stored weights and biases; only the non-zeros of sparse layers."""
+    total = 0
+    for module in model.modules():
+        if isinstance(module, SparseLinear):
+            total += module.nnz() + module.bias.numel()
+        elif isinstance(module, nn.Linear):
+            total += module.weight.numel() + module.bias.numel()
+    return total
+
+
+def distill(student, teacher, epochs=10, batch_size=128, lr=1e-3, masks=None,
+            temperature=TEMPERATURE, alpha=ALPHA, device='cpu', verbose=True):
+    """Train `student` on the teacher's softened predictions.
+
+    `masks` maps parameter names to 0/1 tensors; masked weights are zeroed
+    after every step, so pruned weights stay pruned."""
+    train_data, _, _ = load_splits()
+    iterator = batch_loader(train_data, batch_size, shuffle=True, mean=mean, std=std, seed=seed)
+    augment = build_augment()
+    optimizer = optim.Adam(student.parameters(), lr=lr)
+    params = dict(student.named_parameters())
+    teacher.eval()
+
+    for epoch in range(epochs):
+        iterator.dataset.set_epoch(epoch)
+        student.train()
+        for x, y in iterator:
+            x = augment(x.to(device))
+            y = y.to(device)
+            with torch.no_grad():
+                teacher_pred, _ = teacher(x)
+            y_pred, _ = student(x)
+            soft = F.kl_div(F.log_softmax(y_pred / temperature, dim=1),
+                            F.softmax(teacher_pred / temperature, dim=1),
+                            reduction='batchmean') * temperature ** 2
+            loss = alpha * soft + (1 - alpha) * F.cross_entropy(y_pred, y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if masks:
+                with torch.no_grad():
+                    for name, mask in masks.items():
+                        params[name].mul_(mask)
+        if verbose:
+            print(f'\tepoch {epoch + 1}/{epochs} | loss {loss.item():.3f}')
+    return student.eval()
+
+
+def _activation_stats(model, n_images=CALIBRATION_IMAGES):
+    """Mean and std of every input pixel and every `h_1` unit over training images."""
+    train_data, _, _ = load_splits()
+    x, _ = StoreBatches(train_data.subset(0, min(n_images, len(train_data))), n_images,
+                        mean=mean, std=std)[0]
+    x = x.reshape(x.shape[0], -1)
+    with torch.no_grad():
+        h_1 = F.relu(model.input_fc(x))
+    return x.mean(0), x.std(0), h_1.mean(0), h_1.std(0)
+
+
+def prune_structured(model, keep_inputs=392, keep_hidden=128):
+    """Keep the `keep_inputs` pixels and `keep_hidden` units of `input_fc`
+    whose weights times activation spread are largest.
+
+    Removed inputs and units are replaced by their mean, which is folded
+    into the bias of the layer that reads them."""
+    x_mean, x_std, h_mean, h_std = _activation_stats(model)
+    w_1 = model.input_fc.weight.detach()
+    w_2 = model.hidden_fc.weight.detach()
+
+    pixels = (w_1.norm(dim=0) * x_std).topk(keep_inputs).indices.sort().values
+    units = (w_2.norm(dim=0) * h_std).topk(keep_hidden).indices.sort().values
+    dropped_pixels = torch.ones(w_1.shape[1], dtype=torch.bool)
+    dropped_pixels[pixels] = False
+    dropped_units = torch.ones(w_1.shape[0], dtype=torch.bool)
+    dropped_units[units] = False
+
+    input_fc = nn.Linear(keep_inputs, keep_hidden)
+    hidden_fc = nn.Linear(keep_hidden, model.hidden_fc.out_features)
+    with torch.no_grad():
+        input_fc.weight.copy_(w_1[units][:, pixels])
+        input_fc.bias.copy_(model.input_fc.bias[units] + w_1[units][:, dropped_pixels] @ x_mean[dropped_pixels])
+        hidden_fc.weight.copy_(w_2[:, units])
+        hidden_fc.bias.copy_(model.hidden_fc.bias + w_2[:, dropped_units] @ h_mean[dropped_units])
+    return PrunedMLP(pixels, input_fc, hidden_fc, copy.deepcopy(model.output_fc))
+
+
+def magnitude_masks(model, sparsity):
+    """Masks that zero the `sparsity` fraction of smallest `input_fc` weights."""
+    weight = model.input_fc.weight.detach()
+    k = int(weight.numel() * sparsity)
+    threshold = weight.abs().flatten().kthvalue(k).values if k else -1
+    return {'input_fc.weight': (weight.abs() > threshold).float()}
+
+
+def to_sparse(model):
+    sparse = copy.deepcopy(model)
+    sparse.input_fc = SparseLinear.from_dense(model.input_fc)
+    return sparse.eval()
+
+
+def save(model, path):
+    """Save any variant; sparse weights as CSR with int16 column indices."""
+    layers = {}
+    for name in ('input_fc', 'hidden_fc', 'output_fc'):
+        layer = getattr(model, name)
+        if isinstance(layer, SparseLinear):
+            w = layer.weight
+            layers[name] = {'crow_indices': w.crow_indices().int(),
+                            'col_indices': w.col_indices().short(),
+                            'values': w.values(),
+                            'shape': tuple(w.shape),
+                            'bias': layer.bias.detach()}
+        else:
+            layers[name] = {'weight': layer.weight.detach(), 'bias': layer.bias.detach()}
+    keep_inputs = getattr(model, 'keep_inputs', torch.arange(28 * 28))
+    torch.save({'keep_inputs': keep_inputs.short(), 'layers': layers}, path)
+
+
+def load(path):
+    state = torch.load(path, weights_only=True)
+    layers = []
+    for name in ('input_fc', 'hidden_fc', 'output_fc'):
+        layer = state['layers'][name]
+        if 'values' in layer:
+            weight = torch.sparse_csr_tensor(layer['crow_indices'].long(), layer['col_indices'].long(),
+                                             layer['values'], layer['shape'])
+            layers.append(SparseLinear(weight.to_dense(), layer['bias']))
+        else:
+            out_features, in_features = layer['weight'].shape
+            linear = nn.Linear(in_features, out_features)
+            linear.load_state_dict({'weight': layer['weight'], 'bias': layer['bias']})
+            layers.append(linear)
+    return PrunedMLP(state['keep_inputs'].long(), *layers).eval()
+
+
+def pareto(rows, keys=(('test_acc', max), ('params', min), ('latency_ms', min))):
+    """Mark the rows that no other row beats or equals on every key."""
+    def at_least_as_good(a, b):
+        return all((a[k] >= b[k]) if best is max else (a[k] <= b[k]) for k, best in keys)
+
+    for row in rows:
+        row['pareto'] = not any(other is not row and at_least_as_good(other, row)
+                                and any(other[k] != row[k] for k, _ in keys) for other in rows)
+    return rows
+
+
+def measure(name, model, test_data, threads=1):
+    model.eval()
+    metrics = evaluate_split(model, test_data, mean, std)
+    x = torch.randn(1, 28, 28)
+    previous = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    with torch.no_grad():
+        latency_ms = latency(lambda: model(x), warmup=50, repeat=500) * 1000
+    torch.set_num_threads(previous)
+    return {'variant': name, 'test_acc': metrics['accuracy'], 'params': count_parameters(model),
+            'latency_ms': latency_ms}
+
+
+def write_table(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['variant', 'test_acc', 'params', 'latency_ms', 'pareto'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distill and prune the trained MLP and compare the variants.')
+    parser.add_argument('--model', default='tut1-model.pt', help='the teacher')
+    parser.add_argument('--students', type=parse_hidden, nargs='+', default=[(128, 64), (64, 32), (32, 16)],
+                        help='hidden sizes of the distilled students, as AxB')
+    parser.add_argument('--keep-inputs', type=int, default=392, help='pixels kept by structured pruning')
+    parser.add_argument('--keep-hidden', type=int, default=128, help='input_fc units kept by structured pruning')
+    parser.add_argument('--sparsity', type=float, default=0.9, help='fraction of input_fc weights zeroed')
+    parser.add_argument('--epochs', type=int, default=10, help='distillation epochs for students')
+    parser.add_argument('--finetune-epochs', type=int, default=2, help='distillation epochs after pruning')
+    parser.add_argument('--threads', type=int, default=1, help='threads for the latency measurement')
+    parser.add_argument('--min-accuracy', type=float, default=0.98)
+    parser.add_argument('--table', default='compression-pareto.csv')
+    parser.add_argument('--output', default='tut1-model-compact.pt',
+                        help='where to save the fastest variant reaching --min-accuracy')
+    args = parser.parse_args()
+
+    torch.manual_seed(seed)
+    teacher = load_model(args.model)
+    _, _, test_data = load_splits()
+    variants = [('teacher 250x100', teacher)]
+
+    for h1, h2 in args.students:
+        print(f'Distilling student {h1}x{h2}')
+        variants.append((f'student {h1}x{h2}', distill(MLP(28 * 28, 10, hidden_dims=(h1, h2)), teacher, args.epochs)))
+
+    print(f'Structured pruning to {args.keep_inputs} pixels x {args.keep_hidden} units')
+    pruned = distill(prune_structured(teacher, args.keep_inputs, args.keep_hidden), teacher, args.finetune_epochs)
+    variants.append((f'structured {args.keep_inputs}x{args.keep_hidden}', pruned))
+
+    print(f'Magnitude pruning input_fc to {args.sparsity * 100:.0f}% sparsity')
+    dense = PrunedMLP.from_mlp(teacher)
+    dense = distill(dense, teacher, args.finetune_epochs, masks=magnitude_masks(dense, args.sparsity))
+    variants.append((f'sparse input_fc {args.sparsity * 100:.0f}%', to_sparse(dense)))
+
+    rows = pareto([measure(name, model, test_data, args.threads) for name, model in variants])
+    write_table(rows, args.table)
+
+    print(f'{"variant":<28} {"test acc":>9} {"params":>9} {"batch 1":>10}')
+    for row in sorted(rows, key=lambda r: r['latency_ms']):
+        print(f'{row["variant"]:<28} {row["test_acc"] * 100:>8.2f}% {row["params"]:>9,} '
+              f'{row["latency_ms"]:>7.3f} ms{"  pareto" if row["pareto"] else ""}')
+    print(f'Table written to {args.table}')
+
+    eligible = [row for row in rows if row['test_acc'] >= args.min_accuracy]
+    if not eligible:
+        print(f'No variant reaches {args.min_accuracy * 100:.1f}% test accuracy')
+        return
+    best = min(eligible, key=lambda r: r['latency_ms'])
+    save(dict(variants)[best['variant']], args.output)
+    print(f'Saved {best["variant"]} to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
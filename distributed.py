@@ -0,0 +1,211 @@
+"""Data-parallel training of the MLP over several processes.
+
+Every process holds a replica of the model wrapped in
+`DistributedDataParallel` (gloo backend, so it runs on CPUs), reads its own
+share of the training batches through a `DistributedSampler` and has its
+gradients all-reduced on every step. Validation metrics are summed across
+ranks, so every rank sees the same validation loss, and only rank 0 writes
+the checkpoint.
+
+Single machine, N local processes:
+
+    python distributed.py --nprocs 4 --epochs 10
+
+Several machines, launched with torchrun (which sets RANK/WORLD_SIZE/...):
+
+    torchrun --nnodes 2 --nproc-per-node 8 --rdzv-endpoint host:29500 distributed.py
+"""
+
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+import torch.utils.data as data
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from mnist_store import StoreBatches, build_store
+from multilayer_perceptron_cs213 import (MLP, ROOT, RunningMetrics, build_augment, epoch_time, load_splits, mean,
+                                         seed, std)
+
+
+def _reduce_sums(*values):
+    """All-reduce a few on-device scalars in one collective."""
+    t = torch.stack([torch.as_tensor(v, dtype=torch.float64) for v in values])
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def train(model, iterator, optimizer, criterion, augment=None):
+
+    metrics = RunningMetrics()
+
+    model.train()
+
+    for (x, y) in iterator:
+
+        if augment is not None:
+            x = augment(x)
+
+        optimizer.zero_grad(set_to_none=True)
+
+        y_pred, _ = model(x)
+
+        loss = criterion(y_pred, y)
+
+        loss.backward()  # gradients are all-reduced by DistributedDataParallel
+
+        optimizer.step()
+
+        metrics.update(loss, y_pred, y)
+
+    loss_sum, correct, count = _reduce_sums(metrics.loss_sum, metrics.correct, metrics.count)
+
+    return loss_sum / count, correct / count
+
+
+def evaluate(model, batches, criterion, rank, world_size):
+
+    metrics = RunningMetrics()
+
+    model.eval()
+
+    with torch.no_grad():
+
+        # every rank takes every world_size-th batch, without padding, so no
+        # example is counted twice
+        for i in range(rank, len(batches), world_size):
+
+            x, y = batches[i]
+
+            y_pred, _ = model(x)
+
+            metrics.update(criterion(y_pred, y), y_pred, y)
+
+    loss_sum, correct, count = _reduce_sums(metrics.loss_sum, metrics.correct, metrics.count)
+
+    return loss_sum / count, correct / count
+
+
+def run(rank, world_size, epochs=10, batch_size=64, threads=None,
+        path='tut1-model.pt', result_queue=None, verbose=True):
+    """Body of one training process."""
+
+    # split the cores between the processes on this machine, not the whole job
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(threads or max(1, os.cpu_count() // local_world_size))
+    torch.manual_seed(seed)  # identical initial weights on every rank
+
+    # one process per machine converts the idx files, the others wait for it
+    # instead of racing on the same temporary files
+    if int(os.environ.get('LOCAL_RANK', rank)) == 0:
+        build_store(ROOT)
+    dist.barrier()
+
+    train_data, valid_data, _ = load_splits()
+
+    train_batches = StoreBatches(train_data, batch_size, shuffle=True, mean=mean, std=std, seed=seed)
+    valid_batches = StoreBatches(valid_data, 1024, mean=mean, std=std)
+
+    # the sampler shards the (already shuffled) batches between ranks
+    sampler = DistributedSampler(train_batches, num_replicas=world_size, rank=rank, shuffle=False)
+    train_iterator = data.DataLoader(train_batches, batch_size=None, sampler=sampler)
+
+    model = DistributedDataParallel(MLP(28 * 28, 10))
+    optimizer = optim.Adam(model.parameters())
+    criterion = nn.CrossEntropyLoss()
+    augment = build_augment(seed + rank)
+
+    best_valid_loss = float('inf')
+    history = []
+
+    for epoch in range(epochs):
+
+        start_time = time.monotonic()
+
+        train_batches.set_epoch(epoch)
+        sampler.set_epoch(epoch)
+
+        train_loss, train_acc = train(model, train_iterator, optimizer, criterion, augment)
+
+        train_time = time.monotonic() - start_time
+
+        valid_loss, valid_acc = evaluate(model, valid_batches, criterion, rank, world_size)
+
+        # valid_loss is the same on every rank, only rank 0 writes
+        if valid_loss < best_valid_loss:
+            best_valid_loss = valid_loss
+            if rank == 0:
+                torch.save(model.module.state_dict(), path)
+
+        end_time = time.monotonic()
+
+        history.append({'epoch': epoch + 1,
+                        'epoch_time': end_time - start_time,
+                        'images_per_sec': len(train_data) / train_time,
+                        'train_loss': train_loss,
+                        'train_acc': train_acc,
+                        'valid_loss': valid_loss,
+                        'valid_acc': valid_acc})
+
+        if verbose and rank == 0:
+            epoch_mins, epoch_secs = epoch_time(start_time, end_time)
+            print(f'Epoch: {epoch+1:01} | Epoch Time: {epoch_mins}m {epoch_secs}s | '
+                  f'{world_size} processes, {len(train_data) / train_time:,.0f} images/sec')
+            print(f'\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc*100:.2f}%')
+            print(f'\t Val. Loss: {valid_loss:.3f} |  Val. Acc: {valid_acc*100:.2f}%')
+
+    if rank == 0 and result_queue is not None:
+        result_queue.put(history)
+
+    return history
+
+
+def _worker(rank, world_size, port, kwargs):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        run(rank, world_size, **kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(nprocs, port=29500, **kwargs):
+    """Train with `nprocs` local processes; returns rank 0's history."""
+    queue = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(_worker, args=(nprocs, port, dict(kwargs, result_queue=queue)), nprocs=nprocs)
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Data-parallel MLP training with torch.distributed (gloo).')
+    parser.add_argument('--nprocs', type=int, default=None,
+                        help='local processes to spawn; omit when launched by torchrun')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=64, help='per process')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads per process')
+    parser.add_argument('--port', type=int, default=29500)
+    parser.add_argument('--output', default='tut1-model.pt')
+    args = parser.parse_args()
+
+    kwargs = dict(epochs=args.epochs, batch_size=args.batch_size, threads=args.threads,
+                  path=args.output)
+
+    if 'RANK' in os.environ and args.nprocs is None:
+        dist.init_process_group('gloo')
+        try:
+            run(dist.get_rank(), dist.get_world_size(), **kwargs)
+        finally:
+            dist.destroy_process_group()
+    else:
+        launch(args.nprocs or 2, args.port, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
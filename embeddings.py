@@ -0,0 +1,176 @@
+"""Cached `h_2` embeddings and their 2-D projection.
+
+`MLP.forward` returns the 100-d activation of the second hidden layer, `h_2`.
+Here it is computed for the whole dataset (the training split followed by
+the test split) in large no-grad batches and streamed into an on-disk
+float16 array. The cache lives under a directory named after the hash of the
+checkpoint, so it is reused for as long as the weights do not change, and an
+interrupted extraction carries on where it stopped.
+
+The 2-D projection first reduces the embeddings with PCA, then runs
+Barnes-Hut t-SNE on a random subsample; it is cached next to the embeddings.
+
+    python embeddings.py [--model tut1-model.pt] [--tsne-samples 10000] [--plot tsne.png]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from mnist_store import MNISTStore, StoreBatches
+from multilayer_perceptron_cs213 import ROOT, load_model, load_splits, mean, std
+
+CHUNK_ROWS = 8192
+
+
+def checkpoint_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def cache_dir(model_path, root=ROOT):
+    return os.path.join(root, 'embeddings', checkpoint_hash(model_path))
+
+
+def _write_json(obj, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path + '.tmp', path)
+
+
+def extract(model_path='tut1-model.pt', root=ROOT, batch_size=CHUNK_ROWS, verbose=True):
+    """Compute (or reuse) the embeddings of every training and test image.
+
+    Returns the cache directory, holding `embeddings.npy` (float16,
+    `[n, 100]`, memory-mappable), `labels.npy` and `split.npy` (0 for
+    train, 1 for test)."""
+    directory = cache_dir(model_path, root)
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, 'meta.json')
+    emb_path = os.path.join(directory, 'embeddings.npy')
+
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['rows_done'] == meta['rows']:
+            return directory
+
+    _, _, test_data = load_splits(root)
+    # the whole training split, not only the part showcase() trains on
+    stores = [MNISTStore(root, train=True), test_data]
+    rows = sum(len(s) for s in stores)
+
+    model = load_model(model_path)
+
+    if not meta:
+        meta = {'model': os.path.abspath(model_path), 'rows': rows, 'rows_done': 0}
+        np.save(os.path.join(directory, 'labels.npy'),
+                np.concatenate([np.asarray(s.labels[s.start:s.stop]) for s in stores]))
+        np.save(os.path.join(directory, 'split.npy'),
+                np.concatenate([np.full(len(s), i, dtype=np.uint8) for i, s in enumerate(stores)]))
+        np.lib.format.open_memmap(emb_path, mode='w+', dtype=np.float16,
+                                  shape=(rows, model.hidden_fc.out_features)).flush()
+        _write_json(meta, meta_path)
+
+    embeddings = np.load(emb_path, mmap_mode='r+')
+
+    offset = 0
+    with torch.no_grad():
+        for store in stores:
+            batches = StoreBatches(store, batch_size, mean=mean, std=std)
+            for i in range(len(batches)):
+                n = min(batch_size, len(store) - i * batch_size)
+                if offset + n <= meta['rows_done']:
+                    offset += n
+                    continue
+                x, _ = batches[i]
+                _, h_2 = model(x)
+                embeddings[offset:offset + n] = h_2.numpy().astype(np.float16)
+                offset += n
+                embeddings.flush()
+                meta['rows_done'] = offset
+                _write_json(meta, meta_path)
+                if verbose:
+                    print(f'\rEmbedded {offset}/{rows}', end='', flush=True)
+    if verbose:
+        print()
+    return directory
+
+
+def load(directory):
+    return (np.load(os.path.join(directory, 'embeddings.npy'), mmap_mode='r'),
+            np.load(os.path.join(directory, 'labels.npy')),
+            np.load(os.path.join(directory, 'split.npy')))
+
+
+def project(directory, pca_components=50, tsne_samples=10000, perplexity=30.0, seed=0):
+    """2-D t-SNE coordinates of a subsample of the cached embeddings.
+
+    Returns `(indices, coords)`, with `indices` the rows of the cache that
+    were projected. The result is cached per set of parameters."""
+    path = os.path.join(directory, f'tsne-pca{pca_components}-n{tsne_samples}'
+                                   f'-p{perplexity:g}-s{seed}.npz')
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['indices'], cached['coords']
+
+    from sklearn import decomposition
+    from sklearn import manifold
+
+    embeddings, _, _ = load(directory)
+    rng = np.random.default_rng(seed)
+    n = min(tsne_samples, len(embeddings))
+    indices = np.sort(rng.choice(len(embeddings), size=n, replace=False))
+    x = np.asarray(embeddings[indices], dtype=np.float32)
+
+    x = decomposition.PCA(n_components=min(pca_components, x.shape[1]), random_state=seed).fit_transform(x)
+    coords = manifold.TSNE(n_components=2, method='barnes_hut', perplexity=perplexity,
+                           init='pca', random_state=seed).fit_transform(x)
+
+    np.savez(path + '.tmp.npz', indices=indices, coords=coords.astype(np.float32))
+    os.replace(path + '.tmp.npz', path)
+    return indices, coords
+
+
+def plot_projection(coords, labels, path=None):
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+    scatter = ax.scatter(coords[:, 0], coords[:, 1], c=labels, cmap='tab10', s=2)
+    ax.legend(*scatter.legend_elements(), title='digit')
+    ax.set_title('t-SNE of h_2')
+    if path is None:
+        plt.show()
+    else:
+        fig.savefig(path, dpi=150)
+        plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract, cache and project h_2 embeddings.')
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--batch-size', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--pca-components', type=int, default=50)
+    parser.add_argument('--tsne-samples', type=int, default=10000)
+    parser.add_argument('--perplexity', type=float, default=30.0)
+    parser.add_argument('--plot', default=None, help='save the scatter plot here instead of showing it')
+    args = parser.parse_args()
+
+    directory = extract(args.model, batch_size=args.batch_size)
+    _, labels, _ = load(directory)
+    indices, coords = project(directory, args.pca_components, args.tsne_samples, args.perplexity)
+    print(f'Embeddings and projection cached in {directory}')
+    plot_projection(coords, labels[indices], args.plot)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Every evaluation metric from one no-grad pass over a split.
+
+`MetricAccumulator` keeps running sums on the same device as the logits
+(summed loss, a confusion matrix, per-confidence-bin counts for calibration
+and the most confident mistakes seen so far), so nothing is copied back to
+the host until `compute()` is called at the end. From those it derives:
+
+- exact loss and accuracy, weighted by example rather than by batch,
+- the confusion matrix, rows being the true class,
+- per-class precision and recall,
+- the expected calibration error (ECE) of the softmax confidence over
+  `n_bins` equal-width bins,
+- the `top_k` wrong predictions made with the highest confidence.
+
+`evaluate_split` splits a store into shards of whole batches, evaluates the
+shards on a thread pool with one accumulator each and merges them.
+
+    python evaluation.py [--model tut1-model.pt] [--split test] [--workers 4]
+"""
+
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from mnist_store import StoreBatches
+
+N_BINS = 15
+TOP_K = 10
+
+
+class MetricAccumulator:
+    """Running sums for one split; see the module docstring.
+
+    `criterion` must average over the batch, like `nn.CrossEntropyLoss()`
+    does by default; without one the cross-entropy is used."""
+
+    def __init__(self, n_classes=10, criterion=None, n_bins=N_BINS, top_k=TOP_K, device='cpu'):
+        self.n_classes = n_classes
+        self.criterion = criterion
+        self.n_bins = n_bins
+        self.top_k = top_k
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.confusion = torch.zeros(n_classes * n_classes, dtype=torch.long, device=device)
+        self.bin_count = torch.zeros(n_bins, dtype=torch.long, device=device)
+        self.bin_confidence = torch.zeros(n_bins, dtype=torch.float64, device=device)
+        self.bin_correct = torch.zeros(n_bins, dtype=torch.long, device=device)
+        # confidence, index, label and prediction of the most confident mistakes
+        self.mistakes = torch.zeros(4, 0, dtype=torch.float64, device=device)
+        self.count = 0
+
+    def update(self, logits, y, offset=None):
+        """Add a batch. `offset` is the position of its first example in the
+        split, used to report mistakes; it defaults to the number of examples
+        seen so far, which is right for an unshuffled iterator."""
+        if offset is None:
+            offset = self.count
+        logits = logits.float()
+        n = y.shape[0]
+
+        if self.criterion is not None:
+            loss = self.criterion(logits, y) * n
+        else:
+            loss = F.cross_entropy(logits, y, reduction='sum')
+        self.loss_sum += loss.double()
+
+        confidence, predicted = F.softmax(logits, dim=1).max(1)
+        correct = predicted == y
+        self.confusion += torch.bincount(y * self.n_classes + predicted,
+                                         minlength=self.n_classes * self.n_classes)
+
+        bins = (confidence * self.n_bins).long().clamp_(max=self.n_bins - 1)
+        self.bin_count += torch.bincount(bins, minlength=self.n_bins)
+        self.bin_confidence.index_add_(0, bins, confidence.double())
+        self.bin_correct += torch.bincount(bins, weights=correct.float(), minlength=self.n_bins).long()
+
+        wrong = ~correct
+        index = torch.arange(offset, offset + n, device=y.device)
+        candidates = torch.stack([confidence[wrong].double(), index[wrong].double(),
+                                  y[wrong].double(), predicted[wrong].double()])
+        self._keep_mistakes(candidates)
+        self.count += n
+
+    def _keep_mistakes(self, candidates):
+        mistakes = torch.cat([self.mistakes, candidates], 1)
+        if mistakes.shape[1] > self.top_k:
+            mistakes = mistakes[:, mistakes[0].topk(self.top_k).indices]
+        self.mistakes = mistakes
+
+    def merge(self, other):
+        """Add the sums of another accumulator (e.g. of another shard)."""
+        self.loss_sum += other.loss_sum.to(self.loss_sum.device)
+        self.confusion += other.confusion.to(self.confusion.device)
+        self.bin_count += other.bin_count.to(self.bin_count.device)
+        self.bin_confidence += other.bin_confidence.to(self.bin_confidence.device)
+        self.bin_correct += other.bin_correct.to(self.bin_correct.device)
+        self._keep_mistakes(other.mistakes.to(self.mistakes.device))
+        self.count += other.count
+        return self
+
+    def compute(self):
+        """Copy the sums to the host and derive every metric, as a dict."""
+        count = max(self.count, 1)
+        confusion = self.confusion.view(self.n_classes, self.n_classes).cpu().numpy()
+        correct = np.diag(confusion)
+        predicted = confusion.sum(0)
+        actual = confusion.sum(1)
+
+        bin_count = self.bin_count.cpu().numpy()
+        bin_confidence = self.bin_confidence.cpu().numpy()
+        bin_correct = self.bin_correct.cpu().numpy()
+        nonempty = bin_count > 0
+        gaps = np.abs(bin_correct[nonempty] - bin_confidence[nonempty])
+        ece = float(gaps.sum() / count)
+
+        mistakes = self.mistakes[:, self.mistakes[0].argsort(descending=True)].cpu().numpy()
+
+        return {
+            'count': self.count,
+            'loss': float(self.loss_sum) / count,
+            'accuracy': float(correct.sum()) / count,
+            'confusion': confusion,
+            'precision': np.divide(correct, predicted, out=np.zeros(self.n_classes), where=predicted > 0),
+            'recall': np.divide(correct, actual, out=np.zeros(self.n_classes), where=actual > 0),
+            'ece': ece,
+            'mistakes': [{'index': int(i), 'label': int(label), 'predicted': int(p), 'confidence': float(c)}
+                         for c, i, label, p in mistakes.T],
+        }
+
+
+def _evaluate_shard(model, batches, shard, n_shards, device, accumulator):
+    with torch.no_grad():
+        for i in range(shard, len(batches), n_shards):
+            x, y = batches[i]
+            x, y = x.to(device), y.to(device)
+            y_pred, _ = model(x)
+            accumulator.update(y_pred, y, offset=i * batches.batch_size)
+    return accumulator
+
+
+def evaluate_split(model, store, mean, std, criterion=None, batch_size=1024, workers=1,
+                   device='cpu', n_classes=10):
+    """Evaluate `model` on a whole store in `workers` parallel shards.
+
+    Shards take every `workers`-th batch, so each example is counted exactly
+    once; mistake indices are rows of `store`."""
+    model.eval()
+    batches = StoreBatches(store, batch_size, mean=mean, std=std)
+    workers = max(1, min(workers, len(batches)))
+    accumulators = [MetricAccumulator(n_classes, criterion, device=device) for _ in range(workers)]
+    if workers == 1:
+        _evaluate_shard(model, batches, 0, 1, device, accumulators[0])
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda s: _evaluate_shard(model, batches, s, workers, device, accumulators[s]),
+                          range(workers)))
+    total = accumulators[0]
+    for accumulator in accumulators[1:]:
+        total.merge(accumulator)
+    return total.compute()
+
+
+def format_report(metrics):
+    lines = [f'Examples: {metrics["count"]} | Loss: {metrics["loss"]:.3f} | '
+             f'Acc: {metrics["accuracy"] * 100:.2f}% | ECE: {metrics["ece"] * 100:.2f}%',
+             '',
+             'Confusion matrix (rows: true class, columns: predicted class)']
+    confusion = metrics['confusion']
+    lines.append('      ' + ''.join(f'{c:>6}' for c in range(len(confusion))))
+    for c, row in enumerate(confusion):
+        lines.append(f'{c:>6}' + ''.join(f'{v:>6}' for v in row))
+    lines += ['', f'{"class":>6} {"precision":>10} {"recall":>8}']
+    for c, (p, r) in enumerate(zip(metrics['precision'], metrics['recall'])):
+        lines.append(f'{c:>6} {p * 100:>9.2f}% {r * 100:>7.2f}%')
+    lines += ['', 'Most confident mistakes']
+    for m in metrics['mistakes']:
+        lines.append(f'  #{m["index"]:<6} true {m["label"]} predicted {m["predicted"]} '
+                     f'({m["confidence"] * 100:.1f}% confident)')
+    return '\n'.join(lines)
+
+
+def to_json(metrics):
+    return {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in metrics.items()}
+
+
+def add_arguments(parser):
+    """The options of `python evaluation.py`, shared with the `eval` subcommand."""
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--split', choices=['train', 'valid', 'test'], default='test')
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=1, help='shards evaluated in parallel')
+    parser.add_argument('--json', default=None, help='also write the metrics to this file')
+
+
+def evaluate_saved(args):
+    """Evaluate the saved model on one split, as set by `add_arguments`, print
+    the report and optionally write it as JSON. Returns the metrics."""
+    # imported here so that the main script can import this module
+    from multilayer_perceptron_cs213 import load_model, load_splits, mean, std
+
+    splits = dict(zip(('train', 'valid', 'test'), load_splits()))
+    metrics = evaluate_split(load_model(args.model), splits[args.split], mean, std,
+                             batch_size=args.batch_size, workers=args.workers)
+    print(format_report(metrics))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(to_json(metrics), f, indent=2)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate a trained model on one split in a single pass.')
+    add_arguments(parser)
+    evaluate_saved(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Export the trained MLP as self-contained TorchScript and ONNX graphs.
+
+`tut1-model.pt` is a plain state_dict: using it needs the `MLP` class from
+the training script and eager PyTorch. The exported graphs carry their own
+structure and run with `predictor.py`, through the TorchScript interpreter
+or onnxruntime. Both take `images` (`[batch, 28, 28]`, normalized like
+`test_transforms`, any batch size) and return `logits`; with `--with-hidden`
+they also return `h_2` as a second output.
+
+After exporting, the outputs of both graphs are compared with the eager model.
+
+    python export.py [--model tut1-model.pt] [--with-hidden]
+"""
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from multilayer_perceptron_cs213 import load_model
+from predictor import GraphPredictor
+
+OPSET = 18
+TOLERANCE = 1e-5
+
+
+class ExportedMLP(nn.Module):
+    """`MLP` with the outputs the graphs should have."""
+
+    def __init__(self, model, with_hidden=False):
+        super().__init__()
+        self.model = model
+        self.with_hidden = with_hidden
+
+    def forward(self, images):
+        y_pred, h_2 = self.model(images)
+        if self.with_hidden:
+            return y_pred, h_2
+        return y_pred
+
+
+def output_names(with_hidden):
+    return ['logits', 'h_2'] if with_hidden else ['logits']
+
+
+def export_torchscript(model, path, with_hidden=False):
+    wrapper = ExportedMLP(model, with_hidden).eval()
+    scripted = torch.jit.trace(wrapper, torch.zeros(2, 28, 28))
+    torch.jit.save(scripted, path)
+
+
+def export_onnx(model, path, with_hidden=False, opset=OPSET):
+    wrapper = ExportedMLP(model, with_hidden).eval()
+    torch.onnx.export(wrapper, (torch.zeros(2, 28, 28),), path,
+                      input_names=['images'],
+                      output_names=output_names(with_hidden),
+                      dynamic_shapes={'images': {0: torch.export.Dim('batch')}},
+                      opset_version=opset,
+                      external_data=False,
+                      dynamo=True,
+                      verbose=False)
+
+
+def check_parity(model, path, batch_sizes=(1, 7, 256), tolerance=TOLERANCE):
+    """Largest absolute difference between the graph at `path` and the eager
+    model, over random batches of each size; raises if above `tolerance`."""
+    predictor = GraphPredictor.load(path)
+    generator = torch.Generator().manual_seed(0)
+    worst = 0.0
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 28, 28, generator=generator)
+        with torch.no_grad():
+            expected = model(x)
+        outputs = predictor(x.numpy())
+        for got, want in zip(outputs, expected):
+            worst = max(worst, float(np.abs(got - want.numpy()).max()))
+    if worst > tolerance:
+        raise RuntimeError(f'{path} differs from the eager model by {worst:.3g} (> {tolerance:g})')
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the MLP to TorchScript and ONNX.')
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--torchscript', default='tut1-model.torchscript.pt')
+    parser.add_argument('--onnx', default='tut1-model.onnx')
+    parser.add_argument('--with-hidden', action='store_true', help='also output h_2')
+    parser.add_argument('--opset', type=int, default=OPSET)
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    export_torchscript(model, args.torchscript, args.with_hidden)
+    export_onnx(model, args.onnx, args.with_hidden, args.opset)
+
+    for path in (args.torchscript, args.onnx):
+        worst = check_parity(model, path)
+        print(f'Wrote {path} (max abs difference from eager: {worst:.3g})')
+
+
+if __name__ == '__main__':
+    main()
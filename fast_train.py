@@ -0,0 +1,210 @@
+"""High-throughput training mode for the MLP.
+
+Compared with the `train()`/`evaluate()` loops used by `showcase()`:
+- the forward and backward passes run under bf16 autocast
+- the model is compiled with `torch.compile`
+- loss and accuracy are accumulated on the device and only read back once
+  per epoch, instead of an `.item()` host sync every step
+- large batches are supported by scaling the learning rate with the batch
+  size and warming it up over the first steps
+
+    python fast_train.py --batch-size 1024 --epochs 10
+"""
+
+import argparse
+import math
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from mnist_store import batch_loader
+from multilayer_perceptron_cs213 import (MLP, RunningMetrics, build_augment, epoch_time, load_splits, mean, seed,
+                                         seed_everything, std)
+
+BASE_LR = 1e-3          # Adam's default, tuned for the base batch size
+BASE_BATCH_SIZE = 64
+
+
+def scaled_lr(batch_size, base_lr=BASE_LR, base_batch_size=BASE_BATCH_SIZE, rule='sqrt'):
+    """Learning rate for `batch_size` given one that works for `base_batch_size`.
+
+    'linear' scales with the batch size (the usual rule for SGD), 'sqrt' with
+    its square root, which tends to suit Adam better."""
+    ratio = batch_size / base_batch_size
+    if rule == 'linear':
+        return base_lr * ratio
+    if rule == 'sqrt':
+        return base_lr * math.sqrt(ratio)
+    raise ValueError(f'unknown lr scaling rule: {rule}')
+
+
+def warmup_schedule(optimizer, warmup_steps):
+    """Ramp the learning rate up linearly over `warmup_steps` steps."""
+    warmup_steps = max(1, warmup_steps)
+    return optim.lr_scheduler.LambdaLR(optimizer, lambda step: min(1.0, (step + 1) / warmup_steps))
+
+
+def _autocast(device, amp_dtype):
+    return torch.autocast(device.type, dtype=amp_dtype or torch.bfloat16,
+                          enabled=amp_dtype is not None)
+
+
+def train(model, iterator, optimizer, criterion, device, augment=None,
+          scheduler=None, amp_dtype=torch.bfloat16):
+
+    metrics = RunningMetrics(device)
+
+    model.train()
+
+    for (x, y) in iterator:
+
+        x = x.to(device, non_blocking=True)
+        y = y.to(device, non_blocking=True)
+
+        if augment is not None:
+            x = augment(x)
+
+        optimizer.zero_grad(set_to_none=True)
+
+        with _autocast(device, amp_dtype):
+            y_pred, _ = model(x)
+            loss = criterion(y_pred, y)
+
+        loss.backward()
+
+        optimizer.step()
+
+        if scheduler is not None:
+            scheduler.step()
+
+        # accumulated on the device, read back once at the end of the epoch
+        metrics.update(loss, y_pred, y)
+
+    return metrics.compute()
+
+
+def evaluate(model, iterator, criterion, device, amp_dtype=torch.bfloat16):
+
+    metrics = RunningMetrics(device)
+
+    model.eval()
+
+    with torch.no_grad():
+
+        for (x, y) in iterator:
+
+            x = x.to(device, non_blocking=True)
+            y = y.to(device, non_blocking=True)
+
+            with _autocast(device, amp_dtype):
+                y_pred, _ = model(x)
+                loss = criterion(y_pred, y)
+
+            metrics.update(loss, y_pred, y)
+
+    return metrics.compute()
+
+
+def fit(epochs=10, batch_size=1024, lr=None, lr_rule='sqrt', warmup_epochs=1,
+        amp=True, compile=True, num_workers=0, path='tut1-model.pt',
+        target_acc=None, verbose=True):
+    """Train a fresh `MLP` on the `showcase()` splits.
+
+    The weights with the best validation loss are saved to `path`. Returns
+    the per-epoch history; each entry has the elapsed training time, the
+    training throughput and the validation accuracy, and if `target_acc` is
+    given the run stops once validation accuracy reaches it."""
+
+    seed_everything()
+
+    train_data, valid_data, _ = load_splits()
+
+    train_iterator = batch_loader(train_data, batch_size, shuffle=True, mean=mean,
+                                  std=std, num_workers=num_workers, seed=seed)
+    valid_iterator = batch_loader(valid_data, max(batch_size, 1024), mean=mean,
+                                  std=std, num_workers=num_workers)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    model = MLP(28 * 28, 10).to(device)
+    criterion = nn.CrossEntropyLoss().to(device)
+    optimizer = optim.Adam(model.parameters(), lr=lr or scaled_lr(batch_size, rule=lr_rule))
+    scheduler = warmup_schedule(optimizer, int(warmup_epochs * len(train_iterator)))
+    augment = build_augment()
+    amp_dtype = torch.bfloat16 if amp else None
+
+    # the compiled module shares its parameters with `model`
+    step_model = torch.compile(model) if compile else model
+
+    best_valid_loss = float('inf')
+    history = []
+    elapsed = 0.0
+
+    for epoch in range(epochs):
+
+        start_time = time.monotonic()
+
+        train_iterator.dataset.set_epoch(epoch)
+
+        train_loss, train_acc = train(step_model, train_iterator, optimizer, criterion,
+                                      device, augment, scheduler, amp_dtype)
+
+        train_time = time.monotonic() - start_time
+
+        valid_loss, valid_acc = evaluate(step_model, valid_iterator, criterion, device, amp_dtype)
+
+        if valid_loss < best_valid_loss:
+            best_valid_loss = valid_loss
+            torch.save(model.state_dict(), path)
+
+        end_time = time.monotonic()
+        elapsed += end_time - start_time
+
+        history.append({'epoch': epoch + 1,
+                        'elapsed': elapsed,
+                        'images_per_sec': len(train_data) / train_time,
+                        'train_loss': train_loss,
+                        'train_acc': train_acc,
+                        'valid_loss': valid_loss,
+                        'valid_acc': valid_acc})
+
+        if verbose:
+            epoch_mins, epoch_secs = epoch_time(start_time, end_time)
+            print(f'Epoch: {epoch+1:01} | Epoch Time: {epoch_mins}m {epoch_secs}s | '
+                  f'{len(train_data) / train_time:,.0f} images/sec')
+            print(f'\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc*100:.2f}%')
+            print(f'\t Val. Loss: {valid_loss:.3f} |  Val. Acc: {valid_acc*100:.2f}%')
+
+        if target_acc is not None and valid_acc >= target_acc:
+            break
+
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the MLP with bf16 autocast, torch.compile and large batches.')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--lr', type=float, default=None,
+                        help='defaults to Adam\'s 1e-3 scaled from batch size 64')
+    parser.add_argument('--lr-rule', choices=['sqrt', 'linear'], default='sqrt')
+    parser.add_argument('--warmup-epochs', type=float, default=1)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--no-amp', action='store_true', help='train in fp32')
+    parser.add_argument('--no-compile', action='store_true', help='run eagerly')
+    parser.add_argument('--output', default='tut1-model.pt')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    fit(args.epochs, args.batch_size, args.lr, args.lr_rule, args.warmup_epochs,
+        amp=not args.no_amp, compile=not args.no_compile, num_workers=args.workers,
+        path=args.output)
+
+
+if __name__ == '__main__':
+    main()
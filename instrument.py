@@ -0,0 +1,254 @@
+"""Where the time goes in training and inference loops.
+
+An `Instrumentation` hands out one `LoopTimer` per pass over a loader (a
+training epoch, an evaluation, a prediction run). The timer splits every step
+into phases (time spent waiting for the next batch is `data`; the loop
+decides the rest, e.g. `augment`, `to_device`, `forward`, `backward`,
+`optimizer`) and when the loop is done it reports the totals, samples/sec
+and the peak RSS of the process to its sinks:
+
+- `JsonLinesSink` appends one JSON object per record to a file (or stdout),
+- `PrometheusSink` keeps a Prometheus text-format file up to date, for
+  node_exporter's textfile collector or anything that scrapes files.
+
+With `profile_steps > 0` the first steps are also recorded with
+`torch.profiler` (after one step of wait and one of warmup) and written as a
+TensorBoard trace to `profile_dir`; each phase shows up as a labelled range.
+
+    instrument = Instrumentation([JsonLinesSink('metrics.jsonl')], profile_steps=20)
+    train(model, iterator, optimizer, criterion, device, augment, instrument=instrument)
+    instrument.close()
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import torch
+
+PROMETHEUS_PREFIX = 'digit'
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class JsonLinesSink:
+
+    def __init__(self, path='-'):
+        self.file = sys.stdout if path == '-' else open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class PrometheusSink:
+    """Cumulative counters per loop and phase, rewritten atomically after
+    every loop. Per-step records are ignored."""
+
+    def __init__(self, path):
+        self.path = path
+        self.phase_seconds = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def write(self, record):
+        if record['event'] != 'loop':
+            return
+        loop = record['loop']
+        for phase, seconds in record['phases'].items():
+            key = (loop, phase)
+            self.phase_seconds[key] = self.phase_seconds.get(key, 0.0) + seconds
+        for name in ('steps', 'samples', 'seconds'):
+            key = (name, loop)
+            self.counters[key] = self.counters.get(key, 0) + record[name]
+        self.gauges[('samples_per_second', loop)] = record['samples_per_sec']
+        self.gauges[('peak_rss_bytes', None)] = record['peak_rss_bytes']
+        self._flush()
+
+    def _flush(self):
+        p = PROMETHEUS_PREFIX
+        lines = [f'# TYPE {p}_phase_seconds_total counter']
+        lines += [f'{p}_phase_seconds_total{{loop="{loop}",phase="{phase}"}} {v:.6f}'
+                  for (loop, phase), v in sorted(self.phase_seconds.items())]
+        for name in ('steps', 'samples', 'seconds'):
+            lines.append(f'# TYPE {p}_{name}_total counter')
+            lines += [f'{p}_{name}_total{{loop="{loop}"}} {v}'
+                      for (n, loop), v in sorted(self.counters.items()) if n == name]
+        lines.append(f'# TYPE {p}_samples_per_second gauge')
+        lines += [f'{p}_samples_per_second{{loop="{loop}"}} {v}'
+                  for (n, loop), v in sorted(self.gauges.items(), key=str) if n == 'samples_per_second']
+        lines.append(f'# TYPE {p}_peak_rss_bytes gauge')
+        lines.append(f'{p}_peak_rss_bytes {self.gauges[("peak_rss_bytes", None)]}')
+
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.path)
+
+    def close(self):
+        pass
+
+
+def open_sink(path):
+    """`.prom` files get Prometheus text format, anything else JSON lines."""
+    if path.endswith('.prom'):
+        return PrometheusSink(path)
+    return JsonLinesSink(path)
+
+
+class LoopTimer:
+    """Phase timings of one pass over a loader; see the module docstring."""
+
+    def __init__(self, instrumentation, loop, device=None):
+        self.instrumentation = instrumentation
+        self.loop = loop
+        # CUDA work is asynchronous, so phases only end once the device is done
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.phases = {}
+        self.steps = 0
+        self.samples = 0
+        self.start = None
+
+    def _add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def iterate(self, iterable):
+        """Yield from `iterable`, timing the wait for each item as `data`."""
+        self.start = time.perf_counter()
+        iterator = iter(iterable)
+        while True:
+            t = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._add('data', time.perf_counter() - t)
+            yield item
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self.instrumentation.record_function(name):
+            t = time.perf_counter()
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+            self._add(name, time.perf_counter() - t)
+
+    def step(self, n_samples):
+        self.steps += 1
+        self.samples += n_samples
+        self.instrumentation.step(self)
+
+    def finish(self):
+        seconds = time.perf_counter() - self.start if self.start is not None else 0.0
+        phases = {name: round(s, 6) for name, s in self.phases.items()}
+        phases['other'] = round(max(seconds - sum(self.phases.values()), 0.0), 6)
+        self.instrumentation.emit({
+            'event': 'loop',
+            'loop': self.loop,
+            'steps': self.steps,
+            'samples': self.samples,
+            'seconds': round(seconds, 6),
+            'samples_per_sec': round(self.samples / seconds, 2) if seconds else 0.0,
+            'phases': phases,
+            'peak_rss_bytes': peak_rss_bytes(),
+        })
+
+
+class _NullTimer:
+    """What uninstrumented loops use: no timing at all."""
+
+    def iterate(self, iterable):
+        return iterable
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def step(self, n_samples):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    """Collects `LoopTimer` records into `sinks`.
+
+    `log_every > 0` also emits a record of the cumulative phase times every
+    that many steps, for watching a long loop while it runs."""
+
+    def __init__(self, sinks=(), log_every=0, profile_steps=0, profile_dir='profiles'):
+        self.sinks = list(sinks)
+        self.log_every = log_every
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self._profiled = 0
+
+    def timer(self, loop, device=None):
+        if self.profile_steps and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=self.profile_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.profile_dir),
+                record_shapes=True,
+                profile_memory=True)
+            self.profiler.start()
+        return LoopTimer(self, loop, device)
+
+    def record_function(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return torch.profiler.record_function(name)
+
+    def step(self, timer):
+        if self.profiler is not None:
+            self.profiler.step()
+            self._profiled += 1
+            if self._profiled >= self.profile_steps + 2:
+                self._stop_profiler()
+        if self.log_every and timer.steps % self.log_every == 0:
+            self.emit({'event': 'step',
+                       'loop': timer.loop,
+                       'step': timer.steps,
+                       'samples': timer.samples,
+                       'phases': {name: round(s, 6) for name, s in timer.phases.items()}})
+
+    def _stop_profiler(self):
+        self.profiler.stop()
+        self.profiler = None
+        self.profile_steps = 0
+        self.emit({'event': 'profile', 'trace_dir': os.path.abspath(self.profile_dir)})
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink.write(record)
+
+    def close(self):
+        if self.profiler is not None:
+            self._stop_profiler()
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
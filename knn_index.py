@@ -0,0 +1,208 @@
+"""Nearest-neighbour index over `h_2` embeddings, in NumPy only.
+
+Vectors are scalar-quantized to uint8 (one offset and scale per dimension),
+which makes the index 4x smaller than float32 and lets it be memory-mapped
+from disk. Distances are asymmetric: queries stay in float32 and are compared
+with the decoded vectors, computed block-wise as
+`|q|^2 - 2 q.x + |x|^2` so a batch of queries is a matmul per block.
+
+With `nlist > 0` the index is an IVF: vectors are clustered with k-means,
+stored grouped by cluster, and a query only scans the `nprobe` clusters whose
+centroids are closest to it.
+
+Build it from the cached embeddings of a checkpoint (see `embeddings.py`):
+
+    python knn_index.py [--model tut1-model.pt] [--nlist 256]
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+BLOCK_ROWS = 16384
+
+
+def _sq_dist(a, b, b_norms=None):
+    """Squared distances between the rows of `a` and of `b`."""
+    if b_norms is None:
+        b_norms = (b * b).sum(1)
+    d = (a * a).sum(1)[:, None] - 2 * (a @ b.T) + b_norms[None, :]
+    return np.maximum(d, 0, out=d)
+
+
+def kmeans(x, k, iters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.concatenate([_sq_dist(x[i:i + BLOCK_ROWS], centroids).argmin(1)
+                                 for i in range(0, len(x), BLOCK_ROWS)])
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed clusters that lost all their points
+        centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+    return centroids, assign
+
+
+def _merge(d, i, k):
+    """Keep the `k` smallest distances per row, sorted, with their ids."""
+    k = min(k, d.shape[1])
+    part = np.argpartition(d, k - 1, axis=1)[:, :k]
+    d_k = np.take_along_axis(d, part, 1)
+    i_k = np.take_along_axis(i, part, 1)
+    order = np.argsort(d_k, axis=1)
+    return np.take_along_axis(d_k, order, 1), np.take_along_axis(i_k, order, 1)
+
+
+class VectorIndex:
+    """Quantized flat or IVF index, see the module docstring.
+
+    Search results are row numbers of the vectors the index was built from,
+    together with their labels."""
+
+    def __init__(self, directory, mmap_mode='r'):
+        def array(name):
+            return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.codes = array('codes')
+        self.norms = array('norms')
+        self.ids = array('ids')
+        self.labels = array('labels')
+        self.vmin = np.load(os.path.join(directory, 'vmin.npy'))
+        self.scale = np.load(os.path.join(directory, 'scale.npy'))
+        self.nlist = self.meta['nlist']
+        self.n_classes = int(np.max(self.labels)) + 1
+        if self.nlist:
+            self.centroids = np.load(os.path.join(directory, 'centroids.npy'))
+            self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+
+    @classmethod
+    def load(cls, directory):
+        return cls(directory)
+
+    @staticmethod
+    def build(vectors, labels, directory, nlist=0, iters=20, seed=0):
+        """Quantize `vectors` (`[n, d]`) and write the index to `directory`."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        labels = np.asarray(labels)
+        os.makedirs(directory, exist_ok=True)
+
+        ids = np.arange(len(vectors))
+        meta = {'count': len(vectors), 'dim': vectors.shape[1], 'nlist': nlist}
+        if nlist:
+            centroids, assign = kmeans(vectors, nlist, iters, seed)
+            ids = np.argsort(assign, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+            np.save(os.path.join(directory, 'centroids.npy'), centroids.astype(np.float32))
+            np.save(os.path.join(directory, 'offsets.npy'), offsets)
+
+        vmin = vectors.min(0)
+        scale = (vectors.max(0) - vmin) / 255
+        scale[scale == 0] = 1
+        codes = np.clip(np.rint((vectors[ids] - vmin) / scale), 0, 255).astype(np.uint8)
+        decoded = codes * scale + vmin
+
+        np.save(os.path.join(directory, 'codes.npy'), codes)
+        np.save(os.path.join(directory, 'norms.npy'), (decoded * decoded).sum(1).astype(np.float32))
+        np.save(os.path.join(directory, 'ids.npy'), ids)
+        np.save(os.path.join(directory, 'labels.npy'), labels[ids])
+        np.save(os.path.join(directory, 'vmin.npy'), vmin.astype(np.float32))
+        np.save(os.path.join(directory, 'scale.npy'), scale.astype(np.float32))
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return VectorIndex(directory)
+
+    def _distances(self, queries, start, stop):
+        # |q - x|^2 with x = vmin + scale * code, without decoding x
+        codes = np.asarray(self.codes[start:stop], dtype=np.float32)
+        dots = (queries * self.scale) @ codes.T + (queries @ self.vmin)[:, None]
+        d = (queries * queries).sum(1)[:, None] - 2 * dots + self.norms[start:stop][None, :]
+        return np.maximum(d, 0, out=d)
+
+    def search(self, queries, k=10, nprobe=8):
+        """Return `(distances, positions)` of the `k` nearest vectors to each
+        query, nearest first. `positions` index `self.ids`/`self.labels`."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if not self.nlist:
+            return self._search_flat(queries, k)
+        return self._search_ivf(queries, k, nprobe)
+
+    def _search_flat(self, queries, k):
+        best_d = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        best_i = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.codes), BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, len(self.codes))
+            block = np.broadcast_to(np.arange(start, stop), (len(queries), stop - start))
+            best_d, best_i = _merge(np.concatenate([best_d, self._distances(queries, start, stop)], 1),
+                                    np.concatenate([best_i, block], 1), k)
+        return best_d, best_i
+
+    def _search_ivf(self, queries, k, nprobe):
+        nprobe = min(nprobe, self.nlist)
+        probes = np.argpartition(_sq_dist(queries, self.centroids), nprobe - 1, axis=1)[:, :nprobe]
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, lists in enumerate(probes):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if not len(rows):
+                continue
+            codes = np.asarray(self.codes[rows], dtype=np.float32)
+            query = queries[q:q + 1]
+            dots = (query * self.scale) @ codes.T + query @ self.vmin
+            d = (query * query).sum() - 2 * dots + self.norms[rows][None, :]
+            d_k, i_k = _merge(d, rows[None, :], k)
+            distances[q, :d_k.shape[1]] = d_k[0]
+            positions[q, :i_k.shape[1]] = i_k[0]
+        return distances, positions
+
+    def knn_predict(self, queries, k=10, nprobe=8):
+        """Majority vote of the labels of the `k` nearest training vectors.
+
+        Returns the voted labels and the fraction of neighbours that agree."""
+        _, positions = self.search(queries, k, nprobe)
+        valid = positions >= 0
+        labels = np.where(valid, np.asarray(self.labels)[np.maximum(positions, 0)], -1)
+        votes = np.zeros((len(labels), self.n_classes), dtype=np.int64)
+        for c in range(self.n_classes):
+            votes[:, c] = (labels == c).sum(1)
+        predicted = votes.argmax(1)
+        return predicted, votes.max(1) / np.maximum(valid.sum(1), 1)
+
+    def neighbours(self, queries, k=10, nprobe=8):
+        """Rows of the original vectors nearest to each query, with labels.
+
+        When the probed IVF lists hold fewer than `k` vectors, the missing
+        slots have id and label -1 and an infinite distance."""
+        distances, positions = self.search(queries, k, nprobe)
+        valid = positions >= 0
+        positions = np.maximum(positions, 0)
+        return (distances, np.where(valid, np.asarray(self.ids)[positions], -1),
+                np.where(valid, np.asarray(self.labels)[positions], -1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a kNN index over the training-set h_2 embeddings.')
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--nlist', type=int, default=256, help='IVF clusters, 0 for a flat index')
+    parser.add_argument('--iters', type=int, default=20, help='k-means iterations')
+    args = parser.parse_args()
+
+    # only building needs the embeddings (and therefore torch)
+    import embeddings
+
+    directory = embeddings.extract(args.model)
+    vectors, labels, split = embeddings.load(directory)
+    train = split == 0
+    index_directory = os.path.join(directory, 'knn')
+    index = VectorIndex.build(vectors[train], labels[train], index_directory, args.nlist, args.iters)
+    print(f'Indexed {index.meta["count"]} training embeddings in {index_directory}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""Preprocessed, memory-mapped MNIST store.
+
+`datasets.MNIST` hands out one PIL image at a time, so every epoch pays for a
+Python-level decode/transform/collate per sample. Here the raw idx files are
+converted once into contiguous `.npy` arrays which are then opened with
+`mmap_mode`, so a batch is just a slice of the mapped file. Worker processes
+re-open the map themselves instead of receiving a pickled copy, which means
+they all share the same pages through the OS page cache.
+
+The training split is written in a seeded, shuffled order so that the
+validation set can simply be the tail of it and a batch of consecutive rows is
+already a random sample.
+"""
+
+import gzip
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+
+IMAGE_MAGIC = 2051
+LABEL_MAGIC = 2049
+
+RAW_FILES = {
+    True: ('train-images-idx3-ubyte', 'train-labels-idx1-ubyte'),
+    False: ('t10k-images-idx3-ubyte', 't10k-labels-idx1-ubyte'),
+}
+
+
+def _split_name(train):
+    return 'train' if train else 'test'
+
+
+def store_dir(root):
+    return os.path.join(root, 'MNIST', 'store')
+
+
+def store_paths(root, train=True, dtype='uint8'):
+    # uint8 images are raw pixels, float16 images are already normalized;
+    # every dtype has its own labels, since each is shuffled with its own seed
+    suffix = '' if dtype == 'uint8' else '-' + dtype
+    name = _split_name(train)
+    return (os.path.join(store_dir(root), f'{name}-images{suffix}.npy'),
+            os.path.join(store_dir(root), f'{name}-labels{suffix}.npy'))
+
+
+def _open_raw(path):
+    # torchvision keeps both the .gz and the extracted file around, either will do
+    if os.path.exists(path):
+        return open(path, 'rb')
+    if os.path.exists(path + '.gz'):
+        return gzip.open(path + '.gz', 'rb')
+    raise FileNotFoundError(path)
+
+
+def read_idx(path, magic):
+    with _open_raw(path) as f:
+        header = np.frombuffer(f.read(8), dtype='>i4')
+        if header[0] != magic:
+            raise ValueError(f'{path}: bad idx magic number {header[0]}')
+        n = int(header[1])
+        if magic == IMAGE_MAGIC:
+            rows, cols = np.frombuffer(f.read(8), dtype='>i4')
+            shape = (n, int(rows), int(cols))
+        else:
+            shape = (n,)
+        return np.frombuffer(f.read(), dtype=np.uint8).reshape(shape)
+
+
+def _raw_available(raw_dir):
+    return all(os.path.exists(os.path.join(raw_dir, name)) or
+               os.path.exists(os.path.join(raw_dir, name + '.gz'))
+               for names in RAW_FILES.values() for name in names)
+
+
+def build_store(root, dtype='uint8', mean=None, std=None, seed=0, force=False):
+    """Convert the raw idx files under `root` into the memory-mapped store.
+
+    Does nothing if the store already exists (unless `force`). With
+    `dtype='float16'` the images are stored pre-normalized with `mean`/`std`.
+    """
+    if dtype not in ('uint8', 'float16'):
+        raise ValueError(f'unsupported store dtype: {dtype}')
+    if dtype == 'float16' and (mean is None or std is None):
+        raise ValueError('a float16 store needs mean and std')
+
+    raw_dir = os.path.join(root, 'MNIST', 'raw')
+    if not _raw_available(raw_dir):
+        # only place torchvision is needed: fetching missing raw files
+        import torchvision.datasets as datasets
+        datasets.MNIST(root=root, train=True, download=True)
+        datasets.MNIST(root=root, train=False, download=True)
+
+    os.makedirs(store_dir(root), exist_ok=True)
+
+    for train in (True, False):
+        image_path, label_path = store_paths(root, train, dtype)
+        if not force and os.path.exists(image_path) and os.path.exists(label_path):
+            continue
+
+        image_file, label_file = RAW_FILES[train]
+        images = read_idx(os.path.join(raw_dir, image_file), IMAGE_MAGIC)
+        labels = read_idx(os.path.join(raw_dir, label_file), LABEL_MAGIC)
+
+        order = np.arange(len(images))
+        if train:
+            order = np.random.default_rng(seed).permutation(len(images))
+
+        out = np.lib.format.open_memmap(image_path + '.tmp', mode='w+',
+                                        dtype=dtype, shape=images.shape)
+        if dtype == 'uint8':
+            out[:] = images[order]
+        else:
+            out[:] = ((images[order].astype(np.float32) / 255 - mean) / std).astype(np.float16)
+        out.flush()
+        del out
+        os.replace(image_path + '.tmp', image_path)
+
+        with open(label_path + '.tmp', 'wb') as f:
+            np.save(f, labels[order].astype(np.int64))
+        os.replace(label_path + '.tmp', label_path)
+
+    return store_dir(root)
+
+
+class MNISTStore(data.Dataset):
+    """A (view of a) split of the memory-mapped store.
+
+    Indexing a single sample behaves like `datasets.MNIST`: it returns a PIL
+    image passed through `transform` and an integer label. Whole batches are
+    read with `batch()`, which slices the map without copying.
+    """
+
+    def __init__(self, root, train=True, dtype='uint8', transform=None,
+                 start=0, stop=None):
+        self.root = root
+        self.train = train
+        self.dtype = dtype
+        self.transform = transform
+        self.image_path, self.label_path = store_paths(root, train, dtype)
+        if not os.path.exists(self.image_path):
+            raise FileNotFoundError(f'{self.image_path} not found, run build_store() first')
+        self._images = None
+        self._labels = None
+        n = len(self.labels)
+        self.start = start
+        self.stop = n if stop is None else stop
+
+    # opened lazily (and per process) so every worker maps the same file
+    # instead of receiving a pickled copy of the arrays
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.image_path, mmap_mode='c')
+        return self._images
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = np.load(self.label_path, mmap_mode='c')
+        return self._labels
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_labels'] = None
+        return state
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        img = self.images[self.start + index]
+        if self.dtype == 'uint8':
+            img = Image.fromarray(np.asarray(img))
+        else:
+            img = torch.from_numpy(img).float().unsqueeze(0)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.labels[self.start + index])
+
+    def batch(self, start, stop):
+        """Return `(images, labels)` for rows [start, stop) as numpy views."""
+        return (self.images[self.start + start:self.start + stop],
+                self.labels[self.start + start:self.start + stop])
+
+    def take(self, rows):
+        """Return `(images, labels)` for the given sorted rows, as copies."""
+        rows = self.start + rows
+        return self.images[rows], self.labels[rows]
+
+    def subset(self, start, stop):
+        return MNISTStore(self.root, self.train, self.dtype, self.transform,
+                          self.start + start, self.start + stop)
+
+    def split(self, ratio):
+        """Split into a leading `ratio` part and the remainder.
+
+        The train split is stored shuffled, so this is a random split."""
+        n_first = int(len(self) * ratio)
+        return self.subset(0, n_first), self.subset(n_first, len(self))
+
+    def __repr__(self):
+        return (f'MNISTStore\n'
+                f'    Number of datapoints: {len(self)}\n'
+                f'    Split: {_split_name(self.train)} [{self.start}:{self.stop}]\n'
+                f'    Storage: {self.image_path} ({self.dtype})')
+
+
+class StoreBatches(data.Dataset):
+    """Dataset whose items are whole batches of a `MNISTStore`.
+
+    Use with `DataLoader(batch_size=None)`; see `batch_loader`. With
+    `shuffle=True` the rows are reshuffled every epoch, like a shuffled
+    `DataLoader`: each batch gathers its rows from the memory map in sorted
+    order (about 50 KB of reads per batch of 64).
+
+    `shuffle='blocks'` instead permutes the order of contiguous slices and
+    moves their boundaries by a random offset. Reads are then plain slices,
+    which is faster from a cold disk, but a sample's batch-mates stay nearly
+    the same from one epoch to the next.
+    """
+
+    def __init__(self, store, batch_size, shuffle=False, mean=None, std=None,
+                 seed=0):
+        if store.dtype == 'uint8' and (mean is None or std is None):
+            raise ValueError('uint8 stores need mean and std to normalize')
+        self.store = store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.mean = mean
+        self.std = std
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        n = len(self.store)
+        bounds = list(range(0, n, self.batch_size)) + [n]
+        order = np.arange(len(bounds) - 1)
+        self._rows = None
+        if self.shuffle == 'blocks':
+            rng = np.random.default_rng((self.seed, epoch))
+            offset = int(rng.integers(self.batch_size))
+            if offset:
+                bounds = [0] + list(range(offset, n, self.batch_size)) + [n]
+            order = rng.permutation(len(bounds) - 1)
+        elif self.shuffle:
+            self._rows = np.random.default_rng((self.seed, epoch)).permutation(n)
+        self._bounds = bounds
+        self._order = order
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, index):
+        i = self._order[index]
+        if self._rows is not None:
+            images, labels = self.store.take(np.sort(self._rows[self._bounds[i]:self._bounds[i + 1]]))
+        else:
+            images, labels = self.store.batch(self._bounds[i], self._bounds[i + 1])
+        x = torch.from_numpy(images).unsqueeze(1)
+        if self.store.dtype == 'uint8':
+            x = x.float().div_(255).sub_(self.mean).div_(self.std)
+        else:
+            x = x.float()
+        return x, torch.from_numpy(labels)
+
+
+def batch_loader(store, batch_size, shuffle=False, mean=None, std=None,
+                 num_workers=0, seed=0):
+    batches = StoreBatches(store, batch_size, shuffle=shuffle, mean=mean,
+                           std=std, seed=seed)
+    return data.DataLoader(batches, batch_size=None, shuffle=False,
+                           num_workers=num_workers)
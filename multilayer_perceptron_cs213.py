@@ -21,57 +21,57 @@ We'll process the dataset, build our model, and then train our model. Afterwards
 Let's start by importing all the modules we'll need. The main ones we need to import are:
 - torch for general PyTorch functionality
 - torch.nn and torch.nn.functional for neural network based functions
-- torch.optim for our optimizer which will update the parameters of our neural network
-- torch.utils.data for handling the dataset
-- torchvision.transforms for data augmentation
-- torchvision.datasets for loading the dataset
-- sklearn's metrics for visualizing a confusion matrix
-- sklearn's decomposition and manifold for visualizing the neural network's representations in two dimensions
-- matplotlib for plotting
+- mnist_store for loading the dataset from a memory-mapped copy of the raw MNIST files
+- augment for data augmentation
+
+Importing this file should stay cheap, as the model is also used by short-lived prediction jobs. Modules that are only needed for training or plotting are imported where they are used:
+- torch.optim for our optimizer which will update the parameters of our neural network (in `showcase()`)
+- tqdm for progress bars (in `train()`, `evaluate()` and `showcase()`)
+- matplotlib for plotting (in `showcase()` and `trial()`)
+- torchvision.transforms for the reference per-image transforms (in `build_transforms()`)
+- cv2, through preprocess, for reading images (in `trial()`)
 """
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.optim as optim
-import torch.utils.data as data
-
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
-
-from sklearn import metrics
-from sklearn import decomposition
-from sklearn import manifold
-from tqdm.notebook import trange, tqdm  #provides progress bars
-import matplotlib.pyplot as plt
 import numpy as np
 
-import copy
 import random
 import time
 import os
 
-import cv2 
+from augment import BatchAugment
+from checkpoint import CheckpointManager, capture_rng_state, restore_rng_state
+from evaluation import MetricAccumulator, format_report
+from instrument import NULL_TIMER, Instrumentation, open_sink
+from mnist_store import MNISTStore, StoreBatches, batch_loader, build_store
 #whats a seed
 seed=0
-random.seed(seed)
-np.random.seed(seed)
-torch.manual_seed(seed)
-torch.cuda.manual_seed(seed)
-torch.backends.cudnn.deterministic = True
+
+def seed_everything(seed=seed):
+    # called by showcase() and the command line rather than on import, so importing this file changes no global state
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.backends.cudnn.deterministic = True
 
 ROOT = '.data'
 mean=0.1307
 std=0.3801
+VALID_RATIO=0.9 # fraction of the training set kept for training, the rest is validation
+KNN_CONFIDENCE=0.9 # trial() consults the kNN index below this softmax confidence
 
 # 784 -> 250 -> 100 -> 10 neural net wil Relu activation function at every junction
+# (the hidden layer sizes can be changed with hidden_dims)
 class MLP(nn.Module):
-    def __init__(self, input_dim, output_dim):
+    def __init__(self, input_dim, output_dim, hidden_dims=(250, 100)):
         super().__init__()
 
-        self.input_fc = nn.Linear(input_dim, 250)
-        self.hidden_fc = nn.Linear(250, 100)
-        self.output_fc = nn.Linear(100, output_dim)
+        self.input_fc = nn.Linear(input_dim, hidden_dims[0])
+        self.hidden_fc = nn.Linear(hidden_dims[0], hidden_dims[1])
+        self.output_fc = nn.Linear(hidden_dims[1], output_dim)
 
     def forward(self, x):
 
@@ -96,7 +96,21 @@ class MLP(nn.Module):
         # y_pred = [batch size, output dim]
 
         return y_pred, h_2
-    
+
+
+def load_splits(root=ROOT):
+    # the same train/validation/test stores that showcase() uses
+    build_store(root)
+    train_data, valid_data = MNISTStore(root, train=True).split(VALID_RATIO)
+    return train_data, valid_data, MNISTStore(root, train=False)
+
+
+def load_model(path='tut1-model.pt', device='cpu'):
+    # trained weights, ready for inference
+    model = MLP(784, 10)
+    model.load_state_dict(torch.load(path, map_location=device, weights_only=True))
+    return model.to(device).eval()
+
 
 """A `transform` states how our data should be augmented and processed. Data augmentation involves manipulating the available training data in a way that artificially creates more training examples. We use `transforms.Compose` to built a list of transformations that will be applied to the image.
 
@@ -109,36 +123,210 @@ The transforms we use are:
 The first two transformations have to be applied before `ToTensor` as they should both be applied on a PIL image. `Normalize` should only be applied to the images after they have been converted into a tensor. See the Torchvision documentation for [transforms that should be applied to PIL images](https://pytorch.org/vision/stable/transforms.html#transforms-on-pil-image-only) and [transforms that should be applied on tensors](https://pytorch.org/vision/stable/transforms.html#transforms-on-torch-tensor-only).
 
 We have two lists of transforms, a train and a test transform. The train transforms are to artificially create more examples for our model to train on. We do not augment our test data in the same way, as we want a consistent set of examples to evaluate our final model on. The test data, however, should still be normalized.
+
+When training we don't actually run `train_transforms` image by image. `BatchAugment` (see `augment.py`) applies the same random rotation and crop-style shift to a whole batch of normalized tensors at once, after the batch has been loaded. The per-image transforms are kept as the reference it has to match, and are only built when asked for so that torchvision is not imported otherwise.
+"""
+def build_transforms():
+    import torchvision.transforms as transforms
+
+    train_transforms = transforms.Compose([
+                                transforms.RandomRotation(5, fill=(0,)),
+                                transforms.RandomCrop(28, padding=2),
+                                transforms.ToTensor(),
+                                transforms.Normalize(mean=[mean], std=[std])
+                                          ])
+
+    test_transforms = transforms.Compose([
+                               transforms.ToTensor(),
+                               transforms.Normalize(mean=[mean], std=[std])
+                                         ])
+
+    return train_transforms, test_transforms
+
+def build_augment(seed=seed):
+    # the batched equivalent of train_transforms; black pixels are (0 - mean) / std once normalized
+    return BatchAugment(degrees=5, padding=2, fill=(0 - mean) / std, seed=seed)
+
+"""Next, we'll define a function to calculate the accuracy of our model. This takes the index of the highest value for your prediction and compares it against the actual class label. We then divide how many our model got correct by the amount in the batch to calculate accuracy across the batch."""
+
+def calculate_accuracy(y_pred, y):
+    top_pred = y_pred.argmax(1, keepdim=True)
+    correct = top_pred.eq(y.view_as(top_pred)).sum()
+    acc = correct.float() / y.shape[0]
+    return acc
+
+class RunningMetrics:
+    """Loss and accuracy sums over an epoch, kept on the device so that the
+    loop never waits for it; `compute()` reads them back once."""
+
+    def __init__(self, device='cpu'):
+        self.loss_sum = torch.zeros((), device=device)
+        self.correct = torch.zeros((), dtype=torch.long, device=device)
+        self.count = 0
+
+    def update(self, loss, y_pred, y):
+        # `loss` is the batch mean, as from nn.CrossEntropyLoss()
+        self.loss_sum += loss.detach() * y.shape[0]
+        self.correct += (y_pred.argmax(1) == y).sum()
+        self.count += y.shape[0]
+
+    def compute(self):
+        loss_sum, correct = torch.stack([self.loss_sum, self.correct.float()]).tolist()
+        return loss_sum / self.count, correct / self.count
+
+"""We finally define our training loop.
+
+This will:
+- put our model into `train` mode
+- iterate over our dataloader, returning batches of (image, label)
+- place the batch on to our GPU, if we have one
+- augment the batch, if we were given an augmentation
+- clear the gradients calculated from the last batch
+- pass our batch of images, `x`, through to model to get predictions, `y_pred`
+- calculate the loss between our predictions and the actual labels
+- calculate the accuracy between our predictions and the actual labels
+- calculate the gradients of each parameter
+- update the parameters by taking an optimizer step
+- update our metrics
+
+Passing an `Instrumentation` (see `instrument.py`) as `instrument` times each of these phases, plus the wait for the next batch, and reports them with samples/sec and peak memory when the epoch is done. Without it the phases are not timed at all.
+
+Some layers act differently when training and evaluating the model that contains them, hence why we must tell our model we are in "training" mode. The model we are using here does not use any of those layers, however it is good practice to get used to putting your model in training mode.
 """
-train_transforms = transforms.Compose([
-                            transforms.RandomRotation(5, fill=(0,)),
-                            transforms.RandomCrop(28, padding=2),
-                            transforms.ToTensor(),
-                            transforms.Normalize(mean=[mean], std=[std])
-                                      ])
-
-test_transforms = transforms.Compose([
-                           transforms.ToTensor(),
-                           transforms.Normalize(mean=[mean], std=[std])
-                                     ])
-
-def showcase():
-    train_data = datasets.MNIST(root=ROOT,
-                                train=True,
-                                download=True)
+
+def train(model, iterator, optimizer, criterion, device, augment=None, instrument=None):
+    from tqdm.auto import tqdm  #provides progress bars
+
+    timer = instrument.timer('train', device) if instrument is not None else NULL_TIMER
+
+    epoch_loss = 0
+    epoch_acc = 0
+
+    model.train()
+
+    for (x, y) in tqdm(timer.iterate(iterator), total=len(iterator), desc="Training", leave=False):
+
+        with timer.phase('to_device'):
+            x = x.to(device)
+            y = y.to(device)
+
+        if augment is not None:
+            with timer.phase('augment'):
+                x = augment(x)
+
+        with timer.phase('optimizer'):
+            optimizer.zero_grad()
+
+        with timer.phase('forward'):
+            y_pred, _ = model(x)
+
+            loss = criterion(y_pred, y)
+
+            acc = calculate_accuracy(y_pred, y)
+
+        with timer.phase('backward'):
+            loss.backward()
+
+        with timer.phase('optimizer'):
+            optimizer.step()
+
+        epoch_loss += loss.item()
+        epoch_acc += acc.item()
+
+        timer.step(y.shape[0])
+
+    timer.finish()
+
+    return epoch_loss / len(iterator), epoch_acc / len(iterator)
+
+"""The evaluation loop is similar to the training loop. The differences are:
+- we put our model into evaluation mode with `model.eval()`
+- we wrap the iterations inside a `with torch.no_grad()`
+- we do not zero gradients as we are not calculating any
+- we do not calculate gradients as we are not updating parameters
+- we do not take an optimizer step as we are not calculating gradients
+
+`torch.no_grad()` ensures that gradients are not calculated for whatever is inside the `with` block. As our model will not have to calculate gradients, it will be faster and use less memory.
+
+Rather than averaging the loss and accuracy of each batch (which over-weights a smaller last batch, and waits for the device after every batch), the predictions are added to a `MetricAccumulator` (see `evaluation.py`). It keeps exact running sums on the device and is only read once, at the end. The same accumulator also gives us a confusion matrix, per-class precision and recall, calibration and the most confident mistakes, which we look at for the test set.
+"""
+
+def evaluate(model, iterator, criterion, device, instrument=None, loop='evaluate', details=False):
+    from tqdm.auto import tqdm
+
+    timer = instrument.timer(loop, device) if instrument is not None else NULL_TIMER
+
+    metrics = MetricAccumulator(criterion=criterion, device=device)
+
+    model.eval()
+
+    with torch.no_grad():
+
+        for (x, y) in tqdm(timer.iterate(iterator), total=len(iterator), desc="Evaluating", leave=False):
+
+            with timer.phase('to_device'):
+                x = x.to(device)
+                y = y.to(device)
+
+            with timer.phase('forward'):
+                y_pred, _ = model(x)
+
+                metrics.update(y_pred, y)
+
+            timer.step(y.shape[0])
+
+    timer.finish()
+
+    results = metrics.compute()
+
+    if details:
+        return results
+
+    return results['loss'], results['accuracy']
+
+"""The final step before training is to define a small function to tell us how long an epoch took."""
+
+def epoch_time(start_time, end_time):
+    elapsed_time = end_time - start_time
+    elapsed_mins = int(elapsed_time / 60)
+    elapsed_secs = int(elapsed_time - (elapsed_mins * 60))
+    return elapsed_mins, elapsed_secs
+
+def showcase(resume=False, metrics=None, profile_steps=0, epochs=10, batch_size=64, num_workers=0, plots=None):
+    """Rather than decoding the dataset through `datasets.MNIST` (one PIL image per sample, every epoch), the raw idx files are converted once into a memory-mapped store (see `mnist_store.py`). Batches are then read from that store in one go (slices for evaluation, reshuffled rows for training) instead of being collated from individual samples.
+
+    With `resume=True`, training continues from the latest checkpoint in `checkpoints/` instead of starting over.
+
+    `metrics` is a file to write per-epoch phase timings, throughput and memory to (Prometheus text format if it ends in `.prom`, JSON lines otherwise), and `profile_steps` records that many training steps with `torch.profiler` into `profiles/` (see `instrument.py`).
+
+    With `plots` set to a directory, figures are saved there as PNG files instead of being shown, so training can run without a display."""
+
+    import torch.optim as optim
+    from tqdm.auto import trange  #provides progress bars
+    import matplotlib
+    if plots is not None:
+        matplotlib.use('Agg')
+        os.makedirs(plots, exist_ok=True)
+    import matplotlib.pyplot as plt
+
+    def save_figure(name):
+        # in headless mode every figure goes to a file, otherwise they are all shown at the end
+        if plots is not None:
+            plt.savefig(os.path.join(plots, name))
+            plt.close()
+
+    seed_everything()
+
+    build_store(ROOT)
+
+    train_data = MNISTStore(ROOT, train=True)
     print(train_data)
 
 
 
-    train_data = datasets.MNIST(root=ROOT,
-                                train=True,
-                                download=True,
-                                transform=train_transforms)
+    train_data = MNISTStore(ROOT, train=True)
 
-    test_data = datasets.MNIST(root=ROOT,
-                            train=False,
-                            download=True,
-                            transform=test_transforms)
+    test_data = MNISTStore(ROOT, train=False)
 
 
     print(f'Number of training examples: {len(train_data)}')
@@ -166,32 +354,31 @@ def showcase():
             ax.imshow(images[i].view(28, 28).cpu().numpy(), cmap='bone')
             ax.axis('off')
 
-    """Let's load 25 images. These will have been processed through our transforms, so will be randomly rotated and cropped.
+    """Let's load 100 images and keep the sixes. These will have been processed through our batch augmentation, so will be randomly rotated and shifted. The fill value is what a black pixel becomes after normalization, as augmentation runs on normalized batches.
 
     It's a good practice to see your data with your transforms applied, so you can ensure they look sensible. For example, it wouldn't make sense to flip the digits horizontally or vertically unless you are expecting to see what in your test data."""
 
+    augment = build_augment()
+
     N_IMAGES = 100
 
-    images = [image for image, label in [train_data[i] for i in range(N_IMAGES)] if label==6]
+    x, y = StoreBatches(train_data, N_IMAGES, mean=mean, std=std)[0]
+
+    images = augment(x)[y == 6]
 
     plot_images(images)
+    save_figure('augmented-sixes.png')
 
     """The MNIST dataset comes with a training and test set, but not a validation set. We want to use a validation set to check how well our model performs on unseen data. Why don't we just use the test data? We should only be measuring our performance over the test set once, after all training is done. We can think of the validation set as a proxy test set we are allowed to look at as much as we want.
 
     Furthermore, we create a validation set, taking 10% of the training set. **Note:** ***the validation set should always be created from the training set. Never take the validation set from the test set.*** When researchers publish research papers they should be comparing performance across the test set and the only way to ensure this is a fair comparison is for all researchers to use the same test set. If the validation set is taken from the test set, then the test set is not the same as everyone else's and the results cannot be compared against each other.
 
-    First, we have to define the exact number of examples that we want to be in each split of the training/validation sets.
+    `VALID_RATIO`, defined at the top of the file, is the fraction of the training set that stays in the training split.
     """
 
-    VALID_RATIO = 0.9
+    """The training split is stored in a (seeded) shuffled order, so taking the last 10% of it gives us a random validation set. The remaining 90% will stay as the training set."""
 
-    n_train_examples = int(len(train_data) * VALID_RATIO)
-    n_valid_examples = len(train_data) - n_train_examples
-
-    """Then, we use the `random_split` function to take a random 10% of the training set to use as a validation set. The remaining 90% will stay as the training set."""
-
-    train_data, valid_data = data.random_split(train_data,
-                                            [n_train_examples, n_valid_examples])
+    train_data, valid_data = train_data.split(VALID_RATIO)
 
     """We can print out the number of examples again to check our splits are correct."""
 
@@ -199,51 +386,54 @@ def showcase():
     print(f'Number of validation examples: {len(valid_data)}')
     print(f'Number of testing examples: {len(test_data)}')
 
-    """One thing to consider is that as the validation set has been created from the training set it has the same transforms as the training set, with the random rotating and cropping. As we want our validation set to act as a proxy for the test set, it should also be fixed, without any random augmentation.
+    """One thing to consider is that as the validation set has been created from the training set, it would be easy to give it the same augmentation as the training set, with the random rotating and cropping. As we want our validation set to act as a proxy for the test set, it should be fixed, without any random augmentation.
 
-    First, let's see what 25 of the images within the validation set look like with the training transforms:
+    First, let's see what 25 of the images within the validation set would look like with the training augmentation:
     """
 
     N_IMAGES = 25
 
-    images = [image for image, label in [valid_data[i] for i in range(N_IMAGES)]]
-
-    plot_images(images)
-
-    """We can now simply replace the validation set's transform by overwriting it with our test transforms from above.
-
-    As the validation set is a `Subset` of the training set, if we change the transforms of one, then by default Torchvision will change the transforms of the other. To stop this from happening, we make a `deepcopy` of the validation data.
-    """
-
-    valid_data = copy.deepcopy(valid_data)
-    valid_data.dataset.transform = test_transforms
-
-    """To double check we've correctly replaced the training transforms, we can view the same set of images and notice how they're more central (no random cropping) and have a more standard orientation (no random rotations)."""
+    x, _ = StoreBatches(valid_data, N_IMAGES, mean=mean, std=std)[0]
 
-    N_IMAGES = 25
+    plot_images(augment(x))
+    save_figure('valid-augmented.png')
 
-    images = [image for image, label in [valid_data[i] for i in range(N_IMAGES)]]
+    """As augmentation is only applied inside the training loop, the validation batches are left as they are. We can view the same set of images and notice how they're more central (no random cropping) and have a more standard orientation (no random rotations)."""
 
-    plot_images(images)
+    plot_images(x)
+    save_figure('valid.png')
 
     """Next, we'll define a `DataLoader` for each of the training/validation/test sets. We can iterate over these, and they will yield batches of images and labels which we can use to train our model.
 
     We only need to shuffle our training set as it will be used for stochastic gradient descent, and we want each batch to be different between epochs. As we aren't using the validation or test sets to update our model parameters, they do not need to be shuffled.
 
-    Ideally, we want to use the biggest batch size that we can. The 64 here is relatively small and can be increased if our hardware can handle it.
+    Ideally, we want to use the biggest batch size that we can. The default of 64 is relatively small and can be increased (`batch_size`) if our hardware can handle it.
+
+    All three iterators yield batches that come straight out of the store, normalized in one go: the validation and test batches are whole slices, and the training batches gather freshly shuffled rows every epoch and are augmented afterwards by `augment`. Worker processes all map the same store file, so adding workers does not add copies of the dataset.
     """
 
-    BATCH_SIZE = 64
+    BATCH_SIZE = batch_size
+    NUM_WORKERS = num_workers
 
-    train_iterator = data.DataLoader(train_data,
-                                    shuffle=True,
-                                    batch_size=BATCH_SIZE)
+    train_iterator = batch_loader(train_data,
+                                  batch_size=BATCH_SIZE,
+                                  shuffle=True,
+                                  mean=mean,
+                                  std=std,
+                                  num_workers=NUM_WORKERS,
+                                  seed=seed)
 
-    valid_iterator = data.DataLoader(valid_data,
-                                    batch_size=BATCH_SIZE)
+    valid_iterator = batch_loader(valid_data,
+                                  batch_size=BATCH_SIZE,
+                                  mean=mean,
+                                  std=std,
+                                  num_workers=NUM_WORKERS)
 
-    test_iterator = data.DataLoader(test_data,
-                                    batch_size=BATCH_SIZE)
+    test_iterator = batch_loader(test_data,
+                                 batch_size=BATCH_SIZE,
+                                 mean=mean,
+                                 std=std,
+                                 num_workers=NUM_WORKERS)
 
 
     INPUT_DIM = 28 * 28
@@ -287,140 +477,89 @@ def showcase():
     model = model.to(device)
     criterion = criterion.to(device)
 
-    """Next, we'll define a function to calculate the accuracy of our model. This takes the index of the highest value for your prediction and compares it against the actual class label. We then divide how many our model got correct by the amount in the batch to calculate accuracy across the batch."""
-
-    def calculate_accuracy(y_pred, y):
-        top_pred = y_pred.argmax(1, keepdim=True)
-        correct = top_pred.eq(y.view_as(top_pred)).sum()
-        acc = correct.float() / y.shape[0]
-        return acc
-
-    """We finally define our training loop.
-
-    This will:
-    - put our model into `train` mode
-    - iterate over our dataloader, returning batches of (image, label)
-    - place the batch on to our GPU, if we have one
-    - clear the gradients calculated from the last batch
-    - pass our batch of images, `x`, through to model to get predictions, `y_pred`
-    - calculate the loss between our predictions and the actual labels
-    - calculate the accuracy between our predictions and the actual labels
-    - calculate the gradients of each parameter
-    - update the parameters by taking an optimizer step
-    - update our metrics
-
-    Some layers act differently when training and evaluating the model that contains them, hence why we must tell our model we are in "training" mode. The model we are using here does not use any of those layers, however it is good practice to get used to putting your model in training mode.
-    """
-
-    def train(model, iterator, optimizer, criterion, device):
+    """Next, we need functions to calculate accuracy, to train for an epoch, to evaluate and to time an epoch. These (`calculate_accuracy`, `train`, `evaluate` and `epoch_time`) are defined above `showcase()` so that other scripts can reuse them."""
 
-        epoch_loss = 0
-        epoch_acc = 0
-
-        model.train()
-
-        for (x, y) in tqdm(iterator, desc="Training", leave=False):
-
-            x = x.to(device)
-            y = y.to(device)
-
-            optimizer.zero_grad()
-
-            y_pred, _ = model(x)
-
-            loss = criterion(y_pred, y)
-
-            acc = calculate_accuracy(y_pred, y)
-
-            loss.backward()
-
-            optimizer.step()
-
-            epoch_loss += loss.item()
-            epoch_acc += acc.item()
-
-        return epoch_loss / len(iterator), epoch_acc / len(iterator)
+    """We're finally ready to train!
 
-    """The evaluation loop is similar to the training loop. The differences are:
-    - we put our model into evaluation mode with `model.eval()`
-    - we wrap the iterations inside a `with torch.no_grad()`
-    - we do not zero gradients as we are not calculating any
-    - we do not calculate gradients as we are not updating parameters
-    - we do not take an optimizer step as we are not calculating gradients
+    During each epoch we calculate the training loss and accuracy, followed by the validation loss and accuracy. We then check if the validation loss achieved is the best validation loss we have seen. If so, we save our model's parameters (called a `state_dict`).
 
-    `torch.no_grad()` ensures that gradients are not calculated for whatever is inside the `with` block. As our model will not have to calculate gradients, it will be faster and use less memory.
+    At the end of every epoch we also save a full checkpoint: the model, the optimizer's state, the epoch, our metrics so far and the state of the random number generators (see `checkpoint.py`). Checkpoints are written in the background and atomically, the best model is exported to `tut1-model.pt`, and a killed run can be resumed from the latest one with `showcase(resume=True)`. Without `resume`, the checkpoints of the previous run are deleted and a new run starts.
     """
 
-    def evaluate(model, iterator, criterion, device):
-
-        epoch_loss = 0
-        epoch_acc = 0
-
-        model.eval()
+    EPOCHS = epochs
 
-        with torch.no_grad():
+    checkpoints = CheckpointManager('checkpoints', keep_last=3, keep_best=3, best_path='tut1-model.pt',
+                                    resume=resume)
 
-            for (x, y) in tqdm(iterator, desc="Evaluating", leave=False):
-
-                x = x.to(device)
-                y = y.to(device)
-
-                y_pred, _ = model(x)
-
-                loss = criterion(y_pred, y)
-
-                acc = calculate_accuracy(y_pred, y)
-
-                epoch_loss += loss.item()
-                epoch_acc += acc.item()
-
-        return epoch_loss / len(iterator), epoch_acc / len(iterator)
-
-    """The final step before training is to define a small function to tell us how long an epoch took."""
-
-    def epoch_time(start_time, end_time):
-        elapsed_time = end_time - start_time
-        elapsed_mins = int(elapsed_time / 60)
-        elapsed_secs = int(elapsed_time - (elapsed_mins * 60))
-        return elapsed_mins, elapsed_secs
-
-    """We're finally ready to train!
-
-    During each epoch we calculate the training loss and accuracy, followed by the validation loss and accuracy. We then check if the validation loss achieved is the best validation loss we have seen. If so, we save our model's parameters (called a `state_dict`).
-    """
-
-    EPOCHS = 10
+    instrument = None
+    if metrics is not None or profile_steps:
+        instrument = Instrumentation([open_sink(metrics)] if metrics is not None else [],
+                                     profile_steps=profile_steps)
 
+    start_epoch = 0
     best_valid_loss = float('inf')
     x=[]
     tr=[]
     va=[]
-    for epoch in trange(EPOCHS):
+
+    state = checkpoints.load_latest(map_location=device) if resume else None
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        augment.generator.set_state(state['augment_rng'])
+        restore_rng_state(state['rng'])
+        best_valid_loss = state['best_valid_loss']
+        x, tr, va = state['history']
+        start_epoch = state['epoch'] + 1
+        print(f'Resuming from epoch {start_epoch + 1}')
+
+    for epoch in trange(start_epoch, EPOCHS):
 
         start_time = time.monotonic()
 
-        train_loss, train_acc = train(model, train_iterator, optimizer, criterion, device)
-        valid_loss, valid_acc = evaluate(model, valid_iterator, criterion, device)
+        train_iterator.dataset.set_epoch(epoch)
 
-        if valid_loss < best_valid_loss:
-            best_valid_loss = valid_loss
-            torch.save(model.state_dict(), 'tut1-model.pt')
+        train_loss, train_acc = train(model, train_iterator, optimizer, criterion, device, augment, instrument)
+        valid_loss, valid_acc = evaluate(model, valid_iterator, criterion, device, instrument, loop='valid')
 
-        end_time = time.monotonic()
+        # the checkpoint manager exports the weights to tut1-model.pt whenever valid_loss is the best so far
+        best_valid_loss = min(best_valid_loss, valid_loss)
 
-        epoch_mins, epoch_secs = epoch_time(start_time, end_time)
         x.append(epoch)
         tr.append(train_acc*100)
         va.append(valid_acc*100)
+
+        checkpoints.save({'model': model.state_dict(),
+                          'optimizer': optimizer.state_dict(),
+                          'augment_rng': augment.generator.get_state(),
+                          'rng': capture_rng_state(),
+                          'best_valid_loss': best_valid_loss,
+                          'history': (x, tr, va)},
+                         epoch=epoch, metric=valid_loss)
+
+        end_time = time.monotonic()
+
+        if instrument is not None:
+            instrument.emit({'event': 'epoch', 'epoch': epoch, 'seconds': round(end_time - start_time, 6),
+                             'train_loss': train_loss, 'train_acc': train_acc,
+                             'valid_loss': valid_loss, 'valid_acc': valid_acc})
+
+        epoch_mins, epoch_secs = epoch_time(start_time, end_time)
         print(f'Epoch: {epoch+1:01} | Epoch Time: {epoch_mins}m {epoch_secs}s')
         print(f'\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc*100:.2f}%')
         print(f'\t Val. Loss: {valid_loss:.3f} |  Val. Acc: {valid_acc*100:.2f}%')
 
-    """Afterwards, we load our the parameters of the model that achieved the best validation loss and then use this to evaluate our model on the test set."""
+    """Afterwards, we wait for the last checkpoint to be written, load our the parameters of the model that achieved the best validation loss and then use this to evaluate our model on the test set."""
+
+    checkpoints.close()
 
     model.load_state_dict(torch.load('tut1-model.pt',weights_only=True))
 
-    test_loss, test_acc = evaluate(model, test_iterator, criterion, device)
+    test_metrics = evaluate(model, test_iterator, criterion, device, instrument, loop='test', details=True)
+    test_loss, test_acc = test_metrics['loss'], test_metrics['accuracy']
+
+    if instrument is not None:
+        instrument.close()
 
     """Our model achieves 98% accuracy on the test set.
 
@@ -429,6 +568,10 @@ def showcase():
 
     print(f'Test Loss: {test_loss:.3f} | Test Acc: {test_acc*100:.2f}%')
 
+    """Accuracy alone doesn't tell us which digits get confused with which, or whether the model's confidence can be trusted. The confusion matrix, per-class precision/recall, the expected calibration error and the mistakes the model was most sure about all come from the same pass over the test set."""
+
+    print(format_report(test_metrics))
+
     plt.plot(x,tr)
     plt.plot(x,va)
     plt.scatter(x,tr)
@@ -437,40 +580,129 @@ def showcase():
     plt.xlabel("No. of epochs")
     plt.ylabel("Accuracy in %")
     plt.title("Accuracy vs epochs")
-    plt.show()
+    if plots is not None:
+        save_figure('accuracy.png')
+    else:
+        plt.show()
+
+def trial(file=None):
+    import matplotlib.pyplot as plt
+    from preprocess import BatchPreprocessor, read_digit
 
-def trial():
     # Load sample image
-    print("Enter file path: ")
-    file=input()
+    if file is None:
+        print("Enter file path: ")
+        file=input()
     #file = r'{path}'
-    test_image = cv2.imread(file, cv2.IMREAD_GRAYSCALE)
+    test_image = read_digit(file)
 
     # Preview sample image
     plt.imshow(test_image, cmap='gray')
 
-    # Format Image
-    img_resized = cv2.resize(test_image, (28, 28), interpolation=cv2.INTER_LINEAR)
-    img_resized = cv2.bitwise_not(img_resized)
+    # Format Image: resize, invert and normalize it exactly like the test set (`test_transforms`)
+    x = BatchPreprocessor(mean, std, max_batch=1)([test_image])
 
     # Preview reformatted image
-    plt.imshow(img_resized, cmap='gray')
-    model=MLP(784,10)
+    plt.imshow(x[0], cmap='gray')
     if os.path.exists('tut1-model.pt'):
-        model.load_state_dict(torch.load('tut1-model.pt',weights_only=True))
+        model = load_model('tut1-model.pt')
     else:
         print("Model not found")
         return
-    pred , _ = model(torch.from_numpy(img_resized).float().unsqueeze(0)) # Convert img_resized to a PyTorch tensor
-    print(F.softmax(pred,dim=1).argmax(1).item())
-
-while(True):
-    action=input("Enter\n 1. to showcase the model\n 2. to try the model\n 3. to exit\n")
-    if action=="1":
-        showcase()
-    elif action=="2":
-        trial()
-    elif action=="3":
-        exit()
-    else:
-        print("Invalid input")
+    pred , h_2 = model(x)
+    probs = F.softmax(pred,dim=1)
+    print(probs.argmax(1).item())
+
+    # for low-confidence predictions, also show what the nearest training examples are (see knn_index.py)
+    confidence = probs.max().item()
+    if confidence < KNN_CONFIDENCE:
+        from embeddings import cache_dir
+        from knn_index import VectorIndex
+        index_directory = os.path.join(cache_dir('tut1-model.pt'), 'knn')
+        if os.path.exists(index_directory):
+            votes, agreement = VectorIndex.load(index_directory).knn_predict(h_2.detach().numpy())
+            print(f"Low confidence ({confidence*100:.0f}%), nearest training examples vote {votes[0]} ({agreement[0]*100:.0f}% agree)")
+        else:
+            print(f"Low confidence ({confidence*100:.0f}%), run knn_index.py to compare with the nearest training examples")
+
+"""Everything above can be used from other scripts, and importing this file has no side effects. From the command line, the steps are subcommands, so they can run unattended (see `main()`):
+
+    python multilayer_perceptron_cs213.py train --epochs 10 --batch-size 64 --workers 2 --threads 4 --plots plots/
+    python multilayer_perceptron_cs213.py eval --split test --workers 4
+    python multilayer_perceptron_cs213.py predict scans/ 'more/*.png' -o predictions.csv
+    python multilayer_perceptron_cs213.py --threads 4 bench --cases forward_b1 trial
+
+`--threads` sets the number of torch threads and can go before or after the subcommand. `bench` passes it on to the benchmark suite, which pins 1 thread when it is not given.
+"""
+
+def main(argv=None):
+    import argparse
+
+    import evaluation
+
+    parser = argparse.ArgumentParser(description='Train, evaluate and use the MNIST MLP.')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads for torch')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='train the model as in showcase()')
+    train_parser.add_argument('--epochs', type=int, default=10)
+    train_parser.add_argument('--batch-size', type=int, default=64)
+    train_parser.add_argument('--workers', type=int, default=0, help='data loading processes')
+    train_parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    train_parser.add_argument('--plots', default=None,
+                              help='save figures to this directory instead of showing them')
+    train_parser.add_argument('--metrics', default=None, help='write phase timings here (see instrument.py)')
+    train_parser.add_argument('--profile-steps', type=int, default=0)
+
+    eval_parser = subparsers.add_parser('eval', help='evaluate a saved model on one split')
+    evaluation.add_arguments(eval_parser)
+
+    predict_parser = subparsers.add_parser('predict', help='predict digits for image files, globs, directories or tar archives')
+    predict_parser.add_argument('inputs', nargs='+')
+    predict_parser.add_argument('-o', '--output', default='-', help='.csv or .parquet file, - for stdout')
+    predict_parser.add_argument('--model', default='tut1-model.pt')
+    predict_parser.add_argument('--batch-size', type=int, default=256)
+    predict_parser.add_argument('--top-k', type=int, default=3, help='classes per image, 1 to 10')
+    predict_parser.add_argument('--workers', type=int, default=None, help='decoding processes')
+
+    subparsers.add_parser('bench', help='run the benchmark suite; other options are passed on to benchmarks/suite.py')
+
+    # also accepted after the subcommand; SUPPRESS keeps a value given before it
+    for subparser in (train_parser, eval_parser, predict_parser):
+        subparser.add_argument('--threads', type=int, default=argparse.SUPPRESS, help='intra-op threads for torch')
+
+    args, bench_options = parser.parse_known_args(argv)
+    if bench_options and args.command != 'bench':
+        parser.error(f'unrecognized arguments: {" ".join(bench_options)}')
+    if args.command == 'predict' and not 1 <= args.top_k <= 10:
+        parser.error('--top-k must be between 1 and 10')
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.command == 'train':
+        showcase(resume=args.resume, metrics=args.metrics, profile_steps=args.profile_steps,
+                 epochs=args.epochs, batch_size=args.batch_size, num_workers=args.workers,
+                 plots=args.plots)
+
+    elif args.command == 'eval':
+        evaluation.evaluate_saved(args)
+
+    elif args.command == 'predict':
+        import sys
+        from batch_predict import predict
+
+        n_predicted, n_failed = predict(load_model(args.model), args.inputs, args.output,
+                                        args.batch_size, args.top_k, args.workers)
+        print(f'{n_predicted} predictions ({n_failed} failed)', file=sys.stderr)
+
+    elif args.command == 'bench':
+        from benchmarks import suite
+
+        # the suite pins its own thread count (1 by default), so hand it ours
+        if args.threads is not None and '--threads' not in bench_options:
+            bench_options = ['--threads', str(args.threads)] + bench_options
+        suite.main(bench_options)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Pure-NumPy inference for the MLP.
+
+Loading torch just to run three small matmuls dominates the run time of
+short-lived jobs. This module only imports NumPy: the weights of a trained
+`MLP` are exported once to an uncompressed `.npz` file, already transposed to
+`[in, out]` so the forward pass is `x @ W + b` with no copies at load time.
+
+Export (needs torch, once):
+
+    python numpy_predictor.py export tut1-model.pt tut1-model.npz
+
+Predict on `.npy` arrays of `[28, 28]` or `[N, 28, 28]` images:
+
+    python numpy_predictor.py predict tut1-model.npz digits.npy
+
+The normalization used in training (`mean`/`std`) is stored next to the
+weights. Integer arrays (`uint8`, or the `int64` a plain `np.save` of a
+list gives) are taken as raw white-on-black pixels in 0..255 and normalized
+with it, like `test_transforms`; float arrays must already be normalized.
+"""
+
+import argparse
+
+import numpy as np
+
+LAYERS = ('input_fc', 'hidden_fc', 'output_fc')
+
+
+def export_weights(state_dict, path, mean=None, std=None):
+    """Write the weights of an `MLP` state_dict to `path` as `.npz`, with the
+    input normalization if `mean` and `std` are given.
+
+    Values only need a `.numpy()`-able `.detach().cpu()`, so this module does
+    not import torch itself."""
+    arrays = {}
+    if mean is not None and std is not None:
+        arrays['mean'] = np.float32(mean)
+        arrays['std'] = np.float32(std)
+    for name in LAYERS:
+        weight = state_dict[f'{name}.weight'].detach().cpu().numpy()
+        bias = state_dict[f'{name}.bias'].detach().cpu().numpy()
+        arrays[f'{name}.weight'] = np.ascontiguousarray(weight.T, dtype=np.float32)
+        arrays[f'{name}.bias'] = bias.astype(np.float32)
+    np.savez(path, **arrays)
+
+
+class NumpyMLP:
+    """Same forward pass as `MLP`, returns `(y_pred, h_2)` as NumPy arrays.
+
+    Integer inputs are pixels, normalized with the stored `mean`/`std` first;
+    float inputs are used as they are."""
+
+    def __init__(self, weights):
+        self.input_fc = (weights['input_fc.weight'], weights['input_fc.bias'])
+        self.hidden_fc = (weights['hidden_fc.weight'], weights['hidden_fc.bias'])
+        self.output_fc = (weights['output_fc.weight'], weights['output_fc.bias'])
+        self.table = None
+        if 'mean' in weights and 'std' in weights:
+            # (x / 255 - mean) / std for all 256 pixel values, as in DigitNormalizer
+            values = np.arange(256, dtype=np.float32) / np.float32(255)
+            self.table = (values - weights['mean']) / weights['std']
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as weights:
+            return cls({name: weights[name] for name in weights.files})
+
+    def normalize(self, images):
+        if self.table is None:
+            raise ValueError('these weights were exported without mean/std, '
+                             'pass normalized float images instead')
+        if images.dtype != np.uint8 and images.size and (images.min() < 0 or images.max() > 255):
+            raise ValueError('integer images must hold pixel values between 0 and 255')
+        return self.table[images]
+
+    def __call__(self, x):
+
+        # x = [batch size, height, width]
+
+        x = np.asarray(x)
+        if np.issubdtype(x.dtype, np.integer):
+            x = self.normalize(x)
+        x = np.asarray(x, dtype=np.float32)
+        x = x.reshape(x.shape[0], -1)
+
+        # x = [batch size, height * width]
+
+        h_1 = x @ self.input_fc[0]
+        h_1 += self.input_fc[1]
+        np.maximum(h_1, 0, out=h_1)
+
+        # h_1 = [batch size, 250]
+
+        h_2 = h_1 @ self.hidden_fc[0]
+        h_2 += self.hidden_fc[1]
+        np.maximum(h_2, 0, out=h_2)
+
+        # h_2 = [batch size, 100]
+
+        y_pred = h_2 @ self.output_fc[0]
+        y_pred += self.output_fc[1]
+
+        # y_pred = [batch size, output dim]
+
+        return y_pred, h_2
+
+    def predict_proba(self, x):
+        y_pred, _ = self(x)
+        y_pred -= y_pred.max(axis=1, keepdims=True)
+        np.exp(y_pred, out=y_pred)
+        y_pred /= y_pred.sum(axis=1, keepdims=True)
+        return y_pred
+
+    def predict(self, x):
+        y_pred, _ = self(x)
+        return y_pred.argmax(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NumPy-only MLP inference.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help='convert a state_dict to .npz (needs torch)')
+    export.add_argument('model', nargs='?', default='tut1-model.pt')
+    export.add_argument('output', nargs='?', default='tut1-model.npz')
+
+    predict = subparsers.add_parser('predict', help='predict digits stored in .npy files')
+    predict.add_argument('weights')
+    predict.add_argument('arrays', nargs='+',
+                         help='.npy files of integer pixels or normalized float images')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        import torch
+        from multilayer_perceptron_cs213 import mean, std
+        export_weights(torch.load(args.model, map_location='cpu', weights_only=True), args.output,
+                       mean=mean, std=std)
+        print(f'Wrote {args.output}')
+    else:
+        model = NumpyMLP.load(args.weights)
+        for path in args.arrays:
+            x = np.load(path)
+            if x.ndim == 2:
+                x = x[None]
+            print(path, ' '.join(str(p) for p in model.predict(x)))
+
+
+if __name__ == '__main__':
+    main()
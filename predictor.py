@@ -0,0 +1,94 @@
+"""Run an exported model graph (see `export.py`) without the training script.
+
+`.onnx` files run on onnxruntime, anything else is loaded as TorchScript.
+Only NumPy and the chosen runtime are imported, so an ONNX deployment does
+not need PyTorch at all. Inputs are `[N, 28, 28]` (or `[28, 28]`) float
+arrays, normalized like `test_transforms`.
+
+    python predictor.py tut1-model.onnx digits.npy [--threads 1]
+"""
+
+import argparse
+
+import numpy as np
+
+
+class GraphPredictor:
+    """`__call__` returns the graph's outputs as NumPy arrays: the logits,
+    then `h_2` if the graph was exported with it."""
+
+    def __init__(self, run, output_names):
+        self._run = run
+        self.output_names = output_names
+
+    @classmethod
+    def load(cls, path, threads=None):
+        if path.endswith('.onnx'):
+            return cls._load_onnx(path, threads)
+        return cls._load_torchscript(path, threads)
+
+    @classmethod
+    def _load_onnx(cls, path, threads):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        input_name = session.get_inputs()[0].name
+        output_names = [o.name for o in session.get_outputs()]
+
+        def run(x):
+            return tuple(session.run(output_names, {input_name: x}))
+
+        return cls(run, output_names)
+
+    @classmethod
+    def _load_torchscript(cls, path, threads):
+        import torch
+
+        if threads is not None:
+            torch.set_num_threads(threads)
+        module = torch.jit.load(path, map_location='cpu').eval()
+
+        def run(x):
+            with torch.no_grad():
+                outputs = module(torch.from_numpy(x))
+            if isinstance(outputs, torch.Tensor):
+                outputs = (outputs,)
+            return tuple(o.numpy() for o in outputs)
+
+        return cls(run, None)
+
+    def __call__(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if x.ndim == 2:
+            x = x[None]
+        return self._run(x)
+
+    def predict_proba(self, x):
+        logits = self(x)[0]
+        logits = logits - logits.max(axis=1, keepdims=True)
+        np.exp(logits, out=logits)
+        logits /= logits.sum(axis=1, keepdims=True)
+        return logits
+
+    def predict(self, x):
+        return self(x)[0].argmax(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict digits with an exported ONNX or TorchScript graph.')
+    parser.add_argument('graph', help='.onnx or TorchScript file written by export.py')
+    parser.add_argument('arrays', nargs='+', help='.npy files of normalized [28, 28] or [N, 28, 28] images')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads')
+    args = parser.parse_args()
+
+    predictor = GraphPredictor.load(args.graph, args.threads)
+    for path in args.arrays:
+        print(path, ' '.join(str(p) for p in predictor.predict(np.load(path))))
+
+
+if __name__ == '__main__':
+    main()
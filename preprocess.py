@@ -0,0 +1,133 @@
+"""Turning scanned digit images into model inputs.
+
+`prepare_digit` mirrors what `trial()` has always done to a file: resize it
+to 28x28 and invert it so the digit is white on black, like MNIST. The model
+was trained on normalized images though (`test_transforms`:
+`ToTensor` then `Normalize(mean, std)`), so inputs must also be normalized;
+`DigitNormalizer` does that for a whole uint8 batch with a single table
+lookup, and `BatchPreprocessor` runs the complete pipeline on a list of
+arbitrary-size images into preallocated buffers.
+"""
+
+import cv2
+import numpy as np
+import torch
+
+MNIST_BOX = 20  # MNIST digits are scaled to fit a 20x20 box...
+MNIST_SIZE = 28  # ...and centred by centre of mass in a 28x28 image
+
+
+def prepare_digit(image):
+    """Resize a grayscale image to 28x28 and invert it."""
+    img_resized = cv2.resize(image, (28, 28), interpolation=cv2.INTER_LINEAR)
+    return cv2.bitwise_not(img_resized)
+
+
+def read_digit(path):
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError(f'could not read image: {path}')
+    return image
+
+
+def decode_digit(buffer):
+    """Decode an encoded (PNG, JPEG, ...) image held in memory as grayscale."""
+    image = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError('could not decode image')
+    return image
+
+
+def center_digit(image, out=None):
+    """MNIST-style centring of a white-on-black digit of any size.
+
+    The image is binarized with Otsu's threshold, so a faint or noisy
+    background does not count as part of the digit. The bounding box of the
+    foreground is scaled to fit a 20x20 box (keeping its aspect ratio) and
+    placed in a 28x28 image so the foreground's centre of mass is in the
+    middle."""
+    if out is None:
+        out = np.empty((MNIST_SIZE, MNIST_SIZE), dtype=np.uint8)
+    out.fill(0)
+
+    if image.min() == image.max():  # blank, no digit to find
+        return out
+    _, mask = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    ys, xs = np.nonzero(mask)
+    if not len(ys):
+        return out
+    box = (slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1))
+    digit = image[box]
+
+    h, w = digit.shape
+    factor = MNIST_BOX / max(h, w)
+    size = (max(1, round(w * factor)), max(1, round(h * factor)))
+    digit = cv2.resize(digit, size, interpolation=cv2.INTER_AREA)
+    mask = cv2.resize(mask[box], size, interpolation=cv2.INTER_AREA)
+
+    moments = cv2.moments(mask, binaryImage=True)
+    if moments['m00']:
+        cy, cx = moments['m01'] / moments['m00'], moments['m10'] / moments['m00']
+    else:
+        cy, cx = (digit.shape[0] - 1) / 2, (digit.shape[1] - 1) / 2
+    top = int(np.clip(round((MNIST_SIZE - 1) / 2 - cy), 0, MNIST_SIZE - digit.shape[0]))
+    left = int(np.clip(round((MNIST_SIZE - 1) / 2 - cx), 0, MNIST_SIZE - digit.shape[1]))
+    out[top:top + digit.shape[0], left:left + digit.shape[1]] = digit
+    return out
+
+
+class DigitNormalizer:
+    """Maps uint8 pixels to model inputs, `(x / 255 - mean) / std`, exactly
+    like `ToTensor` + `Normalize`, optionally inverting first.
+
+    All 256 possible outputs are precomputed, so a batch is normalized with
+    one vectorized lookup."""
+
+    def __init__(self, mean, std, invert=False):
+        values = np.arange(256, dtype=np.float32)
+        if invert:
+            values = 255 - values
+        # same operations, in the same order and precision, as ToTensor + Normalize
+        self.table = torch.from_numpy(values).div(255).sub_(mean).div_(std).numpy()
+
+    def __call__(self, images, out=None):
+        images = np.asarray(images, dtype=np.uint8)
+        if out is None:
+            out = np.empty(images.shape, dtype=np.float32)
+        np.take(self.table, images, out=out)
+        return torch.from_numpy(out)
+
+
+class BatchPreprocessor:
+    """Turns a list of arbitrary-size grayscale scans (dark digit on a light
+    background) into a normalized `[B, 28, 28]` batch.
+
+    Output and intermediate buffers are allocated once for `max_batch` images
+    and reused; the returned tensor is a view of them, valid until the next
+    call. With `center=True` digits are cropped, scaled and centred the way
+    MNIST's were, instead of just resizing the whole image."""
+
+    def __init__(self, mean, std, max_batch=256, center=False):
+        self.max_batch = max_batch
+        self.center = center
+        self._pixels = np.empty((max_batch, 28, 28), dtype=np.uint8)
+        self._out = np.empty((max_batch, 28, 28), dtype=np.float32)
+        # centring inverts before resizing, plain resizing after
+        self._normalize = DigitNormalizer(mean, std, invert=not center)
+
+    def __call__(self, images):
+        n = len(images)
+        if n > self.max_batch:
+            raise ValueError(f'batch of {n} images is larger than max_batch={self.max_batch}')
+
+        for i, image in enumerate(images):
+            if image.dtype != np.uint8:
+                image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+            if self.center:
+                center_digit(cv2.bitwise_not(image), out=self._pixels[i])
+            elif image.shape == (28, 28):
+                self._pixels[i] = image
+            else:
+                cv2.resize(image, (28, 28), dst=self._pixels[i], interpolation=cv2.INTER_LINEAR)
+
+        return self._normalize(self._pixels[:n], out=self._out[:n])
@@ -0,0 +1,134 @@
+"""Int8 quantized variant of the MLP.
+
+Weights are quantized to int8 with one (symmetric) scale per output channel.
+Activation ranges are calibrated by running the fp32 model over the
+validation split, so inference runs entirely on quantized tensors. The two
+hidden layers use the fused quantized linear+ReLU kernel, so the ReLU costs
+neither an extra op dispatch nor an extra pass over memory.
+
+The quantized model keeps the `MLP` interface, `forward` returns
+`(y_pred, h_2)` as float tensors, and is saved as a TorchScript artifact next
+to `tut1-model.pt`:
+
+    python quantize.py [--model tut1-model.pt] [--output tut1-model-int8.pt]
+"""
+
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.intrinsic.quantized as nniq
+import torch.ao.nn.quantized as nnq
+from torch.ao.quantization.observer import MinMaxObserver, PerChannelMinMaxObserver
+
+from mnist_store import batch_loader
+from multilayer_perceptron_cs213 import load_model, load_splits, mean, std
+
+
+def select_engine():
+    # fbgemm is the x86 backend, qnnpack the ARM one
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+    return torch.backends.quantized.engine
+
+
+class QuantizedMLP(nn.Module):
+
+    def __init__(self, input_scale, input_zero_point, input_fc, hidden_fc, output_fc):
+        super().__init__()
+
+        self.input_scale = input_scale
+        self.input_zero_point = input_zero_point
+        self.input_fc = input_fc    # fused linear + relu
+        self.hidden_fc = hidden_fc  # fused linear + relu
+        self.output_fc = output_fc
+
+    def forward(self, x):
+
+        batch_size = x.shape[0]
+
+        x = x.reshape(batch_size, -1)
+
+        x = torch.quantize_per_tensor(x, self.input_scale, self.input_zero_point, torch.quint8)
+
+        h_1 = self.input_fc(x)
+
+        h_2 = self.hidden_fc(h_1)
+
+        y_pred = self.output_fc(h_2)
+
+        return y_pred.dequantize(), h_2.dequantize()
+
+
+def calibrate(model, iterator):
+    """Observe the ranges of the input and of every layer's output."""
+    observers = [MinMaxObserver(dtype=torch.quint8, qscheme=torch.per_tensor_affine)
+                 for _ in range(4)]
+    model.eval()
+    with torch.no_grad():
+        for x, _ in iterator:
+            x = x.reshape(x.shape[0], -1)
+            h_1 = F.relu(model.input_fc(x))
+            h_2 = F.relu(model.hidden_fc(h_1))
+            y_pred = model.output_fc(h_2)
+            for observer, t in zip(observers, (x, h_1, h_2, y_pred)):
+                observer(t)
+    return [observer.calculate_qparams() for observer in observers]
+
+
+def _quantized_linear(cls, linear, output_qparams):
+    observer = PerChannelMinMaxObserver(ch_axis=0, dtype=torch.qint8,
+                                        qscheme=torch.per_channel_symmetric)
+    weight = linear.weight.detach().float()
+    observer(weight)
+    scales, zero_points = observer.calculate_qparams()
+    qweight = torch.quantize_per_channel(weight, scales.double(), zero_points.long(),
+                                         axis=0, dtype=torch.qint8)
+
+    layer = cls(linear.in_features, linear.out_features)
+    layer.set_weight_bias(qweight, linear.bias.detach().float())
+    scale, zero_point = output_qparams
+    layer.scale = float(scale)
+    layer.zero_point = int(zero_point)
+    return layer
+
+
+def quantize(model, iterator):
+    """Build a `QuantizedMLP` from a trained fp32 `MLP`, calibrating
+    activation ranges on the batches of `iterator`."""
+    select_engine()
+    (in_scale, in_zp), h_1, h_2, y_pred = calibrate(model, iterator)
+    return QuantizedMLP(float(in_scale), int(in_zp),
+                        _quantized_linear(nniq.LinearReLU, model.input_fc, h_1),
+                        _quantized_linear(nniq.LinearReLU, model.hidden_fc, h_2),
+                        _quantized_linear(nnq.Linear, model.output_fc, y_pred)).eval()
+
+
+def save(qmodel, path):
+    scripted = torch.jit.trace(qmodel, torch.zeros(1, 28, 28))
+    torch.jit.save(scripted, path)
+
+
+def load(path):
+    select_engine()
+    return torch.jit.load(path).eval()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize the trained MLP to int8.')
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--output', default='tut1-model-int8.pt')
+    parser.add_argument('--batch-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    _, valid_data, _ = load_splits()
+    valid_iterator = batch_loader(valid_data, args.batch_size, mean=mean, std=std)
+
+    qmodel = quantize(load_model(args.model), valid_iterator)
+    save(qmodel, args.output)
+    print(f'Saved int8 model to {args.output} (engine: {torch.backends.quantized.engine})')
+
+
+if __name__ == '__main__':
+    main()
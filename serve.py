@@ -0,0 +1,271 @@
+"""Long-running inference server for the MLP.
+
+The model is loaded once. Requests are accepted concurrently by an asyncio
+HTTP front end and coalesced into micro-batches: the batcher waits for the
+first request, then keeps collecting until it has `max_batch` images or
+`max_wait` seconds have passed, and runs a single `MLP.forward` for all of
+them.
+
+Endpoints:
+
+    POST /predict   body is an encoded image (PNG, JPEG, ...), returns the
+                    predicted digit and the class probabilities as JSON
+    GET  /stats     latency percentiles, throughput and batch sizes
+
+Usage:
+
+    python serve.py [--port 8000 | --unix /tmp/mlp.sock] [--max-batch 64] [--max-wait-ms 2]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from multilayer_perceptron_cs213 import load_model, mean, std
+from preprocess import DigitNormalizer, decode_digit, prepare_digit
+
+
+class LatencyStats:
+    """Rolling window of request latencies plus lifetime counters.
+
+    `throughput_rps` is measured over the window, between the first and the
+    last request in it, so idle time before the load does not dilute it;
+    `lifetime_rps` averages over the whole uptime."""
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.finished = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.completed = 0
+        self.errors = 0
+        self.started = time.monotonic()
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        self.finished.append(time.monotonic())
+        self.completed += 1
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        latencies = np.array(self.latencies) * 1000
+        span = self.finished[-1] - self.finished[0] if len(self.finished) > 1 else 0.0
+        stats = {
+            'completed': self.completed,
+            'errors': self.errors,
+            'uptime_s': round(elapsed, 3),
+            'throughput_rps': round((len(self.finished) - 1) / span, 2) if span else 0.0,
+            'lifetime_rps': round(self.completed / elapsed, 2) if elapsed else 0.0,
+            'mean_batch_size': round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else 0.0,
+        }
+        if len(latencies):
+            stats['p50_ms'] = round(float(np.percentile(latencies, 50)), 3)
+            stats['p99_ms'] = round(float(np.percentile(latencies, 99)), 3)
+        return stats
+
+
+class MicroBatcher:
+    """Collects single images into batches for the model.
+
+    `submit()` returns the probabilities for one `[28, 28]` uint8 image,
+    normalized here like the training data, a whole batch at a time; the model
+    itself runs on a single worker thread so the event loop keeps accepting
+    requests while a batch is being computed.
+    """
+
+    def __init__(self, model, max_batch=64, max_wait=0.002, stats=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats if stats is not None else LatencyStats()
+        self.normalize = DigitNormalizer(mean, std)
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _forward(self, images):
+        x = self.normalize(np.stack(images))
+        with torch.no_grad():
+            y_pred, _ = self.model(x)
+        return F.softmax(y_pred, dim=1).numpy()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            images = [image for image, _ in batch]
+            self.stats.batch_sizes.append(len(batch))
+            try:
+                probs = await loop.run_in_executor(self.executor, self._forward, images)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), p in zip(batch, probs):
+                if not future.done():
+                    future.set_result(p)
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request; returns None when the client hung up."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = (f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(head.encode('latin-1') + body)
+
+
+class InferenceServer:
+
+    def __init__(self, model, max_batch=64, max_wait=0.002):
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(model, max_batch, max_wait, self.stats)
+        # decoding and resizing are done off the event loop
+        self.decode_executor = ThreadPoolExecutor()
+
+    def _prepare(self, body):
+        return prepare_digit(decode_digit(body))
+
+    async def predict(self, body):
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(self.decode_executor, self._prepare, body)
+        probs = await self.batcher.submit(image)
+        self.stats.record(time.monotonic() - start)
+        return {'prediction': int(probs.argmax()),
+                'probabilities': [round(float(p), 6) for p in probs]}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    write_response(writer, 400, {'error': 'malformed request'}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if path == '/predict':
+                    if method != 'POST':
+                        write_response(writer, 405, {'error': 'use POST'}, keep_alive)
+                    else:
+                        try:
+                            write_response(writer, 200, await self.predict(body), keep_alive)
+                        except ValueError as e:
+                            self.stats.errors += 1
+                            write_response(writer, 400, {'error': str(e)}, keep_alive)
+                        except Exception as e:
+                            # e.g. the model failing on the whole batch
+                            self.stats.errors += 1
+                            write_response(writer, 500, {'error': f'{type(e).__name__}: {e}'}, keep_alive)
+                elif path == '/stats':
+                    write_response(writer, 200, self.stats.snapshot(), keep_alive)
+                else:
+                    write_response(writer, 404, {'error': f'unknown path {path}'}, keep_alive)
+
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix=None):
+        self.batcher.start()
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+            where = unix
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = f'http://{host}:{port}'
+        print(f'Serving on {where}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+            self.decode_executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve MLP predictions over HTTP.')
+    parser.add_argument('--model', default='tut1-model.pt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None, help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    server = InferenceServer(load_model(args.model), args.max_batch, args.max_wait_ms / 1000)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.snapshot()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""Hyperparameter sweep that trains many MLP variants at once.
+
+Instead of one full training run per configuration, the K configurations
+that share a batch size and optimizer are stacked into one `BatchedMLP`: the
+weights of all replicas live in `[K, ...]` tensors and a forward pass is
+three batched matmuls. Every step loads and augments one batch and trains all
+K replicas on it.
+
+Replicas can have different hidden sizes: the stacked tensors are as wide as
+the largest configuration and the unused units of smaller ones are masked to
+zero, so they get no gradient and behave exactly like the narrower network.
+Learning rates are per replica.
+
+Losing configurations are stopped early with successive halving: after every
+rung the best `1/eta` of the remaining configurations (across all groups) go
+on to train for `eta` times as many epochs.
+
+    python sweep.py --hidden 250x100 128x64 512x256 --lr 1e-3 3e-3 3e-4 \\
+        --optimizer adam sgd --batch-size 64 256 --rungs 1 3 9
+"""
+
+import argparse
+import csv
+import itertools
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+from mnist_store import batch_loader
+from multilayer_perceptron_cs213 import MLP, build_augment, load_splits, mean, seed, std
+
+ADAM_BETAS = (0.9, 0.999)
+ADAM_EPS = 1e-8
+SGD_MOMENTUM = 0.9
+
+
+class BatchedMLP:
+    """K `MLP` replicas with stacked weights, trained together.
+
+    `configs` is a list of dicts with 'hidden' (a pair of sizes), 'lr',
+    'optimizer' ('adam' or 'sgd') and 'batch_size'; all of them must share
+    the optimizer and batch size.
+    """
+
+    def __init__(self, configs, input_dim=28 * 28, output_dim=10, device='cpu',
+                 generator=None):
+        self.configs = list(configs)
+        self.optimizer = configs[0]['optimizer']
+        K = len(configs)
+        h1 = max(c['hidden'][0] for c in configs)
+        h2 = max(c['hidden'][1] for c in configs)
+
+        def masks(width, index):
+            m = torch.zeros(K, 1, width, device=device)
+            for k, c in enumerate(configs):
+                m[k, :, :c['hidden'][index]] = 1
+            return m
+
+        self.mask_1 = masks(h1, 0)
+        self.mask_2 = masks(h2, 1)
+
+        # nn.Linear's default initialisation, using each replica's real fan-in
+        def init(fan_ins, shape):
+            bound = torch.tensor([1 / math.sqrt(f) for f in fan_ins], device=device)
+            bound = bound.view(K, *([1] * (len(shape) - 1)))
+            t = torch.rand(K, *shape[1:], generator=generator).to(device)
+            return (t * 2 - 1) * bound
+
+        fan_1 = [input_dim] * K
+        fan_2 = [c['hidden'][0] for c in configs]
+        fan_3 = [c['hidden'][1] for c in configs]
+        self.params = {
+            'input_fc.weight': init(fan_1, (K, input_dim, h1)),
+            'input_fc.bias': init(fan_1, (K, 1, h1)),
+            'hidden_fc.weight': init(fan_2, (K, h1, h2)),
+            'hidden_fc.bias': init(fan_2, (K, 1, h2)),
+            'output_fc.weight': init(fan_3, (K, h2, output_dim)),
+            'output_fc.bias': init(fan_3, (K, 1, output_dim)),
+        }
+        for p in self.params.values():
+            p.requires_grad_(True)
+
+        self.lr = torch.tensor([c['lr'] for c in configs], device=device).view(K, 1, 1)
+        self.state = {name: {'step': 0,
+                             'exp_avg': torch.zeros_like(p),
+                             'exp_avg_sq': torch.zeros_like(p)} for name, p in self.params.items()}
+
+    def __len__(self):
+        return len(self.configs)
+
+    def forward(self, x):
+
+        # x = [batch size, height, width]
+
+        x = x.reshape(x.shape[0], -1)
+
+        p = self.params
+
+        h_1 = F.relu(torch.matmul(x, p['input_fc.weight']) + p['input_fc.bias']) * self.mask_1
+
+        # h_1 = [K, batch size, max hidden 1]
+
+        h_2 = F.relu(torch.bmm(h_1, p['hidden_fc.weight']) + p['hidden_fc.bias']) * self.mask_2
+
+        # h_2 = [K, batch size, max hidden 2]
+
+        y_pred = torch.bmm(h_2, p['output_fc.weight']) + p['output_fc.bias']
+
+        # y_pred = [K, batch size, output dim]
+
+        return y_pred
+
+    def loss(self, y_pred, y):
+        # summed over replicas, so each replica gets exactly its own gradient
+        K, B, C = y_pred.shape
+        losses = F.cross_entropy(y_pred.reshape(K * B, C), y.repeat(K), reduction='none')
+        return losses.view(K, B).mean(1)
+
+    @torch.no_grad()
+    def step(self):
+        beta1, beta2 = ADAM_BETAS
+        for name, p in self.params.items():
+            g = p.grad
+            state = self.state[name]
+            state['step'] += 1
+            if self.optimizer == 'adam':
+                state['exp_avg'].mul_(beta1).add_(g, alpha=1 - beta1)
+                state['exp_avg_sq'].mul_(beta2).addcmul_(g, g, value=1 - beta2)
+                m_hat = state['exp_avg'] / (1 - beta1 ** state['step'])
+                v_hat = state['exp_avg_sq'] / (1 - beta2 ** state['step'])
+                p.sub_(self.lr * m_hat / (v_hat.sqrt() + ADAM_EPS))
+            else:
+                state['exp_avg'].mul_(SGD_MOMENTUM).add_(g)
+                p.sub_(self.lr * state['exp_avg'])
+            p.grad = None
+
+    def keep(self, indices):
+        """Drop every replica not in `indices`."""
+        index = torch.tensor(indices, dtype=torch.long, device=self.lr.device)
+
+        def select(t):
+            return t.index_select(0, index)
+
+        self.configs = [self.configs[i] for i in indices]
+        self.mask_1, self.mask_2, self.lr = select(self.mask_1), select(self.mask_2), select(self.lr)
+        for name, p in self.params.items():
+            self.params[name] = select(p.detach()).requires_grad_(True)
+            for key in ('exp_avg', 'exp_avg_sq'):
+                self.state[name][key] = select(self.state[name][key])
+
+    def to_mlp(self, k):
+        """Replica `k` as a regular `MLP`."""
+        h1, h2 = self.configs[k]['hidden']
+        p = {name: t[k].detach() for name, t in self.params.items()}
+        model = MLP(28 * 28, 10, hidden_dims=(h1, h2))
+        model.load_state_dict({
+            'input_fc.weight': p['input_fc.weight'][:, :h1].T,
+            'input_fc.bias': p['input_fc.bias'][0, :h1],
+            'hidden_fc.weight': p['hidden_fc.weight'][:h1, :h2].T,
+            'hidden_fc.bias': p['hidden_fc.bias'][0, :h2],
+            'output_fc.weight': p['output_fc.weight'][:h2].T,
+            'output_fc.bias': p['output_fc.bias'][0],
+        })
+        return model
+
+
+def train_epoch(models, iterator, augment, device):
+    for x, y in iterator:
+        x = augment(x.to(device))
+        y = y.to(device)
+        y_pred = models.forward(x)
+        models.loss(y_pred, y).sum().backward()
+        models.step()
+
+
+def evaluate(models, iterator, device):
+    correct = torch.zeros(len(models), device=device)
+    count = 0
+    with torch.no_grad():
+        for x, y in iterator:
+            x, y = x.to(device), y.to(device)
+            correct += (models.forward(x).argmax(2) == y).sum(1)
+            count += y.shape[0]
+    return (correct / count).tolist()
+
+
+def describe(config):
+    h1, h2 = config['hidden']
+    return f'{h1}x{h2} {config["optimizer"]} lr={config["lr"]:g} bs={config["batch_size"]}'
+
+
+def sweep(configs, rungs=(1, 3, 9), eta=3, device='cpu', verbose=True):
+    """Train every configuration with successive halving.
+
+    Returns one leaderboard row per configuration with the epochs it was
+    trained for, its last validation accuracy and the wall-clock time at
+    which that was measured, plus the `BatchedMLP` groups still alive."""
+
+    train_data, valid_data, _ = load_splits()
+    valid_iterator = batch_loader(valid_data, 1024, mean=mean, std=std)
+    augment = build_augment()
+    generator = torch.Generator().manual_seed(seed)
+
+    groups = {}
+    for c in configs:
+        groups.setdefault((c['batch_size'], c['optimizer']), []).append(c)
+    groups = {key: BatchedMLP(cs, device=device, generator=generator) for key, cs in groups.items()}
+    loaders = {key: batch_loader(train_data, key[0], shuffle=True, mean=mean, std=std, seed=seed)
+               for key in groups}
+    trained = {key: 0 for key in groups}
+
+    rows = {describe(c): {'config': describe(c)} for c in configs}
+    start = time.monotonic()
+
+    for rung, epochs in enumerate(rungs):
+        results = []
+        for key, models in groups.items():
+            if not len(models):
+                continue
+            while trained[key] < epochs:
+                loaders[key].dataset.set_epoch(trained[key])
+                train_epoch(models, loaders[key], augment, device)
+                trained[key] += 1
+            accuracies = evaluate(models, valid_iterator, device)
+            elapsed = time.monotonic() - start
+            for k, (c, acc) in enumerate(zip(models.configs, accuracies)):
+                rows[describe(c)].update(epochs=epochs, valid_acc=acc, wall_clock_s=elapsed)
+                results.append((acc, key, k))
+
+        if verbose:
+            print(f'Rung {rung + 1} ({epochs} epochs): {len(results)} configurations, '
+                  f'best {max(r[0] for r in results) * 100:.2f}% after {time.monotonic() - start:.1f}s')
+
+        if rung == len(rungs) - 1:
+            break
+
+        # successive halving: keep the best 1/eta across all groups
+        n_keep = max(1, math.ceil(len(results) / eta))
+        survivors = sorted(results, key=lambda r: r[0], reverse=True)[:n_keep]
+        for key, models in groups.items():
+            models.keep(sorted(k for _, g, k in survivors if g == key))
+
+    leaderboard = sorted(rows.values(), key=lambda r: (r.get('epochs', 0), r.get('valid_acc', 0)),
+                         reverse=True)
+    return leaderboard, groups
+
+
+def write_leaderboard(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['config', 'epochs', 'valid_acc', 'wall_clock_s'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_hidden(value):
+    h1, h2 = value.lower().split('x')
+    return int(h1), int(h2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train many MLP configurations at once with successive halving.')
+    parser.add_argument('--hidden', type=parse_hidden, nargs='+', default=[(250, 100)],
+                        help='hidden sizes as AxB')
+    parser.add_argument('--lr', type=float, nargs='+', default=[1e-3])
+    parser.add_argument('--optimizer', choices=['adam', 'sgd'], nargs='+', default=['adam'])
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[64])
+    parser.add_argument('--rungs', type=int, nargs='+', default=[1, 3, 9],
+                        help='epochs after which configurations are compared')
+    parser.add_argument('--eta', type=int, default=3, help='keep 1/eta of the configurations per rung')
+    parser.add_argument('--output', default='sweep-leaderboard.csv')
+    parser.add_argument('--save-best', default=None, help='save the winning model\'s state_dict here')
+    args = parser.parse_args()
+
+    configs = [{'hidden': h, 'lr': lr, 'optimizer': opt, 'batch_size': bs}
+               for h, lr, opt, bs in itertools.product(args.hidden, args.lr, args.optimizer, args.batch_size)]
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    leaderboard, groups = sweep(configs, args.rungs, args.eta, device)
+    write_leaderboard(leaderboard, args.output)
+
+    print(f'{"configuration":<40} {"epochs":>6} {"val acc":>8} {"time":>8}')
+    for row in leaderboard:
+        print(f'{row["config"]:<40} {row["epochs"]:>6} {row["valid_acc"] * 100:>7.2f}% {row["wall_clock_s"]:>7.1f}s')
+    print(f'Leaderboard written to {args.output}')
+
+    if args.save_best:
+        best = leaderboard[0]['config']
+        for models in groups.values():
+            for k, c in enumerate(models.configs):
+                if describe(c) == best:
+                    torch.save(models.to_mlp(k).state_dict(), args.save_best)
+                    print(f'Saved {best} to {args.save_best}')
+
+
+if __name__ == '__main__':
+    main()
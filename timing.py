@@ -0,0 +1,21 @@
+"""Wall-clock timing helpers, used by `compress.py` and the benchmark scripts."""
+
+import time
+
+
+def timings(fn, warmup=10, repeat=100):
+    """Run `fn` `warmup + repeat` times and return the seconds of each timed call."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def latency(fn, warmup=10, repeat=100):
+    """Run `fn` `warmup + repeat` times and return the median seconds per call."""
+    times = sorted(timings(fn, warmup, repeat))
+    return times[len(times) // 2]